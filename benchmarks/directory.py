@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Compares loading users.xml scaled up with the tree-based parser the app used
+to have and the incremental UserDirectory.parse.
+
+Usage: bin/python-console benchmarks/directory.py [scale]
+"""
+import os
+import resource
+import sys
+import tempfile
+import time
+
+from lxml import etree
+
+from presence_analyzer.directory import UserDirectory
+from presence_analyzer.utils import get_user_data
+
+
+DATA_XML = os.path.join(
+    os.path.dirname(__file__), '..', 'runtime', 'data', 'users.xml'
+)
+
+
+def scale_xml(scale):
+    """
+    Writes users.xml with users repeated `scale` times with distinct ids.
+    """
+    tree = etree.parse(DATA_XML)
+    users = tree.find('users')
+    originals = list(users)
+
+    for copy in xrange(1, scale):
+        for user in originals:
+            clone = etree.fromstring(etree.tostring(user))
+            clone.set('id', str(int(user.get('id')) + copy * 1000))
+            users.append(clone)
+
+    handle, path = tempfile.mkstemp(suffix='.xml')
+    with os.fdopen(handle, 'w') as output:
+        tree.write(output, encoding='UTF-8', xml_declaration=True)
+    return path
+
+
+def parse_tree(path):
+    """
+    Parses users the way get_users_avatar_name() used to.
+    """
+    tree = etree.parse(path)
+    server = tree.find('server')
+    address = '{}://{}:{}'.format(
+        server.find('protocol').text,
+        server.find('host').text,
+        server.find('port').text
+    )
+    result = {}
+    for user in tree.find('users').xpath('//user'):
+        data = get_user_data(user, address)
+        result[data['id']] = data['data']
+    return result
+
+
+def rss():
+    """
+    Returns current resident set size in MB.
+    """
+    with open('/proc/self/statm') as statm:
+        pages = int(statm.read().split()[1])
+    return pages * resource.getpagesize() / 1024.0 / 1024.0
+
+
+def peak_rss():
+    """
+    Returns peak resident set size in MB.
+    """
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024.0
+
+
+def measure(function, path):
+    """
+    Runs function in a child process, returns duration and peak growth of
+    RSS in MB.
+    """
+    read, write = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(read)
+        baseline = rss()
+        started = time.time()
+        users = function(path)
+        duration = time.time() - started
+        peak = peak_rss() - baseline
+        os.write(write, '{} {} {}'.format(duration, peak, len(users)))
+        os._exit(0)  # pylint: disable=protected-access
+
+    os.close(write)
+    result = os.read(read, 1024)
+    os.waitpid(pid, 0)
+    duration, peak, count = result.split()
+    return float(duration), float(peak), int(count)
+
+
+def main():
+    """
+    Prints load time and peak memory of both parsers.
+    """
+    scale = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    path = scale_xml(scale)
+    try:
+        for name, function in (('etree.parse', parse_tree),
+                               ('iterparse', UserDirectory.parse)):
+            duration, peak, count = measure(function, path)
+            print '{:12} {} users {:7.2f} s  peak RSS +{:.1f} MB'.format(
+                name, count, duration, peak
+            )
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
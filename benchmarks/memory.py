@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Compares memory held by the dict-of-dicts presence structure and by the
+columnar PresenceStore on sample_data.csv scaled up.
+
+Usage: bin/python-console benchmarks/memory.py [scale]
+"""
+import gc
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+from csv import reader
+
+from presence_analyzer import loader
+
+
+DATA_CSV = os.path.join(
+    os.path.dirname(__file__), '..', 'runtime', 'data', 'sample_data.csv'
+)
+
+
+def scale_csv(scale):
+    """
+    Writes sample data repeated `scale` times with distinct user ids.
+    """
+    with open(DATA_CSV, 'r') as csvfile:
+        rows = [row for row in reader(csvfile) if len(row) == 5]
+
+    handle, path = tempfile.mkstemp(suffix='.csv')
+    with os.fdopen(handle, 'w') as output:
+        for copy in xrange(scale):
+            for row in rows:
+                output.write('{},{}\n'.format(
+                    int(row[0]) + copy * 1000, ','.join(row[1:])
+                ))
+    return path
+
+
+def rss():
+    """
+    Returns current resident set size in MB.
+    """
+    with open('/proc/self/statm') as statm:
+        pages = int(statm.read().split()[1])
+    return pages * resource.getpagesize() / 1024.0 / 1024.0
+
+
+def rows_of(path):
+    """
+    Yields parsed rows of given CSV file.
+    """
+    with open(path, 'r') as csvfile:
+        for row in reader(csvfile):
+            yield (
+                int(row[0]), loader.parse_date(row[1]), row[2], row[3], row[4]
+            )
+
+
+def build_dict(path):
+    """
+    Builds presence structure the way get_data() used to.
+    """
+    data = {}
+    for user_id, date, start, end, _ in rows_of(path):
+        data.setdefault(user_id, {})[date] = {
+            'start': loader.parse_time(start),
+            'end': loader.parse_time(end),
+        }
+    return data
+
+
+def build_store(path):
+    """
+    Builds columnar PresenceStore.
+    """
+    presence = loader.PresenceAggregate()
+    for user_id, date, start, end, location in rows_of(path):
+        presence.add(
+            user_id,
+            date,
+            loader.parse_seconds(start),
+            loader.parse_seconds(end),
+            location
+        )
+    return presence.result()
+
+
+def measure(mode, path):
+    """
+    Prints memory held by the structure built in given mode.
+    """
+    gc.collect()
+    before = rss()
+    data = {'dict': build_dict, 'store': build_store}[mode](path)
+    gc.collect()
+    print '{:<6} retained {:8.1f} MB  peak {:8.1f} MB'.format(
+        mode,
+        rss() - before,
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0 - before,
+    )
+    return data
+
+
+def main():
+    """
+    Measures every mode in a separate process.
+    """
+    if len(sys.argv) == 3:
+        measure(sys.argv[1], sys.argv[2])
+        return
+
+    scale = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    path = scale_csv(scale)
+    try:
+        print 'sample_data.csv x{}'.format(scale)
+        for mode in ('dict', 'store'):
+            subprocess.check_call([sys.executable, __file__, mode, path])
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
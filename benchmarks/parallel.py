@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+Measures full load of sample_data.csv scaled up with different numbers of
+parsing worker processes.
+
+Usage: bin/python-console benchmarks/parallel.py [scale]
+"""
+import os
+import sys
+import time
+
+from presence_analyzer import loader
+
+from memory import scale_csv
+
+
+def main():
+    """
+    Prints load time for 1, 2, 4 and 8 workers.
+    """
+    scale = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    path = scale_csv(scale)
+    try:
+        print 'sample_data.csv x{}, {} CPUs'.format(
+            scale, os.sysconf('SC_NPROCESSORS_ONLN')
+        )
+        baseline = None
+        for workers in (1, 2, 4, 8):
+            csv_loader = loader.CSVLoader(loader.AGGREGATES)
+            started = time.time()
+            csv_loader.load(path, workers=workers)
+            duration = time.time() - started
+            baseline = baseline or duration
+            print '{} workers {:8.2f} s  x{:.2f}'.format(
+                workers, duration, baseline / duration
+            )
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Compares strptime based parsing of the presence export with the fixed-format
+parsers from presence_analyzer.loader.
+
+Usage: bin/python-console benchmarks/parsing.py [path/to/data.csv]
+"""
+import os
+import sys
+from csv import reader
+from datetime import datetime
+from timeit import repeat
+
+from presence_analyzer import loader
+
+
+DATA_CSV = os.path.join(
+    os.path.dirname(__file__), '..', 'runtime', 'data', 'sample_data.csv'
+)
+
+
+def load_rows(path):
+    """
+    Returns valid rows of given CSV file.
+    """
+    with open(path, 'r') as csvfile:
+        return [row for row in reader(csvfile) if len(row) == 5]
+
+
+def parse_strptime(rows):
+    """
+    Parses rows the way get_data() used to.
+    """
+    for row in rows:
+        datetime.strptime(row[1], '%Y-%m-%d').date()
+        datetime.strptime(row[2], '%H:%M:%S').time()
+        datetime.strptime(row[3], '%H:%M:%S').time()
+
+
+def parse_fixed(rows):
+    """
+    Parses rows into date and time objects with fixed-format parsers.
+    """
+    for row in rows:
+        loader.parse_date(row[1])
+        loader.parse_time(row[2])
+        loader.parse_time(row[3])
+
+
+def parse_fixed_seconds(rows):
+    """
+    Parses rows into date objects and seconds since midnight.
+    """
+    for row in rows:
+        loader.parse_date(row[1])
+        loader.parse_seconds(row[2])
+        loader.parse_seconds(row[3])
+
+
+def main():
+    """
+    Prints best of five timings for each parsing method.
+    """
+    path = sys.argv[1] if len(sys.argv) > 1 else DATA_CSV
+    rows = load_rows(path)
+    print '{} rows from {}'.format(len(rows), path)
+
+    baseline = None
+    for function in (parse_strptime, parse_fixed, parse_fixed_seconds):
+        best = min(repeat(lambda: function(rows), number=1, repeat=5))
+        baseline = baseline or best
+        print '{:<22} {:8.2f} ms  x{:.1f}'.format(
+            function.__name__, best * 1000, baseline / best
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+Shows that peak memory of streaming aggregation over sample_data.csv scaled
+up does not grow with size of the input.
+
+Usage: bin/python-console benchmarks/streaming.py [scale ...]
+"""
+import os
+import resource
+import subprocess
+import sys
+import time
+
+from presence_analyzer import loader
+
+from memory import scale_csv
+
+
+def measure(path):
+    """
+    Prints peak RSS after streaming given file through month/location sink.
+    """
+    started = time.time()
+    result, = loader.stream_csv(path, [loader.YearMonthLocationAggregate()])
+    print '{:>10} bytes  {:6.2f} s  {:3} months  peak {:6.1f} MB'.format(
+        os.path.getsize(path),
+        time.time() - started,
+        len(result),
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+    )
+
+
+def main():
+    """
+    Measures every scale in a separate process.
+    """
+    if len(sys.argv) == 3 and sys.argv[1] == 'measure':
+        measure(sys.argv[2])
+        return
+
+    for scale in [int(arg) for arg in sys.argv[1:]] or [1, 10, 50]:
+        path = scale_csv(scale)
+        try:
+            subprocess.check_call([sys.executable, __file__, 'measure', path])
+        finally:
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+Compares pure Python and NumPy computation of weekday and month/location
+totals over sample_data.csv scaled up.
+
+Usage: bin/python-console benchmarks/vectorized.py [scale]
+"""
+import os
+import sys
+from timeit import repeat
+
+import mock
+
+from presence_analyzer import loader, store, vectorized
+
+from memory import scale_csv
+
+
+def weekday_totals(presence):
+    """
+    Recomputes weekday totals of all users.
+    """
+    if vectorized.is_available():
+        return vectorized.weekday_totals(
+            presence.user_ids, presence.days, presence.starts, presence.ends,
+            presence.index
+        )
+    return {
+        user_id: store.sum_by_weekday(
+            presence.days, presence.starts, presence.ends, begin, end
+        )
+        for user_id, (begin, end) in presence.index.iteritems()
+    }
+
+
+def main():
+    """
+    Prints best of three timings of both implementations.
+    """
+    scale = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    path = scale_csv(scale)
+    try:
+        csv_loader = loader.CSVLoader(loader.AGGREGATES)
+        presence = csv_loader.load(path)['presence']
+    finally:
+        os.remove(path)
+
+    print 'sample_data.csv x{}, {} entries'.format(scale, len(presence))
+    for name, function in (
+            ('weekday totals', lambda: weekday_totals(presence)),
+            ('month/location totals', presence.month_location_totals),
+    ):
+        with mock.patch.object(vectorized, 'numpy', None):
+            python = min(repeat(function, number=1, repeat=3))
+        numpy = min(repeat(function, number=1, repeat=3))
+        print '{:24} python {:7.3f} s  numpy {:7.3f} s  x{:.1f}'.format(
+            name, python, numpy, python / numpy
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -39,10 +39,14 @@ setup(
         'lxml',
         'mock',
     ],
+    extras_require={
+        'numpy': ['numpy'],
+    },
     entry_points="""
     [console_scripts]
     flask-ctl = presence_analyzer.script:run
     update_user_data = presence_analyzer.script:update_user_data
+    refresh_data = presence_analyzer.script:refresh_data
 
     [paste.app_factory]
     main = presence_analyzer.script:make_app
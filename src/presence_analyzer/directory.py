@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+Directory of users exported from the intranet.
+"""
+import sys
+from bisect import bisect_left
+from collections import Mapping
+from unicodedata import normalize
+
+from lxml import etree
+
+
+POLISH_ALPHABET = (
+    u'0123456789'
+    u'aąbcćdeęfghijklłmnńoópqrsśtuvwxyzźż'
+)
+
+_collation_ranks = {  # pylint: disable=invalid-name
+    letter: rank for rank, letter in enumerate(POLISH_ALPHABET)
+}
+
+
+def collation_rank(letter):
+    """
+    Returns primary collation weight of a lowercase letter or digit, None
+    for characters ignored by collation, like spaces and punctuation.
+    """
+    rank = _collation_ranks.get(letter)
+    if rank is not None:
+        return rank
+
+    base = normalize('NFD', letter)[0]
+    if base in _collation_ranks:
+        return _collation_ranks[base]
+    if letter.isalnum():
+        return min(len(POLISH_ALPHABET) + ord(letter), sys.maxunicode)
+    return None
+
+
+def collation_key(text):
+    """
+    Returns primary collation key of text in Polish order, which ignores
+    case, spaces and punctuation.
+
+    Key is a UTF-8 encoded string of characters with collation ranks as
+    code points. UTF-8 keeps order of code points, and letters of the
+    alphabet take a single byte, so keys of many users take little memory.
+    """
+    ranks = (collation_rank(letter) for letter in unicode(text).lower())
+    return u''.join(
+        unichr(rank) for rank in ranks if rank is not None
+    ).encode('utf-8')
+
+
+def case_key(text):
+    """
+    Returns key ordering lower case before upper case letters of text.
+    """
+    return ''.join(
+        '1' if letter.isupper() else '0'
+        for letter in text if letter.isalnum()
+    )
+
+
+def sort_key(text):
+    """
+    Returns key sorting text in Polish order like pl_PL locale, with lower
+    case first among otherwise equal texts.
+    """
+    return collation_key(text), case_key(text), text
+
+
+class UserDirectory(dict):
+    """
+    Users from the intranet export, keyed by user_id.
+
+    Every user is a dict with 'name' and full URL of 'avatar', `server` is
+    the address avatars are served from. Ids of users sorted by name in
+    Polish order are kept in `sorted_ids`, built once with the directory,
+    with collation keys of names in `collation_keys`.
+    """
+
+    def __init__(self, users=(), server=''):
+        super(UserDirectory, self).__init__(users)
+        self.server = server
+
+        # Sorts by parts of sort_key from the last one, as sorts are stable,
+        # so only collation keys, which are kept, are built for all users.
+        user_ids = sorted(self, key=lambda user_id: self[user_id]['name'])
+        user_ids.sort(key=lambda user_id: case_key(self[user_id]['name']))
+        keys = [collation_key(self[user_id]['name']) for user_id in user_ids]
+        order = sorted(xrange(len(keys)), key=keys.__getitem__)
+
+        self.sorted_ids = [user_ids[i] for i in order]
+        self.collation_keys = [keys[i] for i in order]
+
+    @classmethod
+    def parse(cls, source):
+        """
+        Reads users from XML file or file-like object.
+
+        The export is parsed incrementally and elements are dropped as soon
+        as they are read, so memory use does not grow with the whole tree.
+        """
+        users = {}
+        server = ''
+
+        for _, element in etree.iterparse(source, tag=('server', 'user')):
+            if element.tag == 'user':
+                users[int(element.get('id'))] = {
+                    'name': element.findtext('name', ''),
+                    'avatar': element.findtext('avatar', ''),
+                }
+            else:
+                server = '{}://{}:{}'.format(
+                    element.findtext('protocol'),
+                    element.findtext('host'),
+                    element.findtext('port')
+                )
+
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+        for user in users.itervalues():
+            user['avatar'] = server + user['avatar']
+
+        return cls(users, server)
+
+    def listing(self, begin=0, end=None):
+        """
+        Returns users between given positions of `sorted_ids`, like:
+        [
+            {'user_id': 130, 'name': 'Kajetan O.'},
+            {'user_id': 141, 'name': 'Adam P.'},
+        ]
+        """
+        return [
+            {'user_id': user_id, 'name': self[user_id]['name']}
+            for user_id in self.sorted_ids[begin:end]
+        ]
+
+    def search(self, prefix=''):
+        """
+        Returns range of `sorted_ids` with users whose names start with given
+        prefix, ignoring case, spaces and punctuation.
+        """
+        key = collation_key(prefix)
+        if not key:
+            return 0, len(self.sorted_ids)
+
+        keys = self.collation_keys
+        begin = bisect_left(keys, key)
+        ranks = key.decode('utf-8').rstrip(unichr(sys.maxunicode))
+        if not ranks:
+            return begin, len(keys)
+        end = bisect_left(
+            keys,
+            (ranks[:-1] + unichr(ord(ranks[-1]) + 1)).encode('utf-8'),
+            begin
+        )
+        return begin, end
+
+
+class JoinedUser(object):
+    """
+    Read-only view of a user from the directory joined with presence
+    entries of the user, referencing both without copying them.
+    """
+    __slots__ = ('user_id', 'info', 'store')
+    fields = ('name', 'avatar', 'presence')
+
+    def __init__(self, user_id, info, store):
+        self.user_id = user_id
+        self.info = info
+        self.store = store
+
+    @property
+    def name(self):
+        """
+        Returns name of the user.
+        """
+        return self.info['name']
+
+    @property
+    def avatar(self):
+        """
+        Returns URL of avatar of the user.
+        """
+        return self.info['avatar']
+
+    @property
+    def presence(self):
+        """
+        Returns presence of the user in the dict-of-dicts shape, built on
+        each access.
+        """
+        return self.store.user_dict(self.user_id)
+
+    def weekday_totals(self, since=None, until=None):
+        """
+        Returns per-weekday totals of presence of the user.
+        """
+        return self.store.weekday_totals(self.user_id, since, until)
+
+    def __getitem__(self, key):
+        if key not in self.fields:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def as_dict(self):
+        """
+        Returns user's data as a dict.
+        """
+        return {field: getattr(self, field) for field in self.fields}
+
+
+class JoinedUsers(Mapping):
+    """
+    Read-only mapping of user_id to JoinedUser over users of a directory
+    and a presence store. Users are created on lookup, so the directory and
+    the store stay unchanged and can be shared between threads.
+    """
+
+    def __init__(self, directory, store):
+        self.directory = directory
+        self.store = store
+
+    def __getitem__(self, user_id):
+        return JoinedUser(user_id, self.directory[user_id], self.store)
+
+    def __contains__(self, user_id):
+        return user_id in self.directory
+
+    def __iter__(self):
+        return iter(self.directory)
+
+    def __len__(self):
+        return len(self.directory)
+
+    def as_dict(self):
+        """
+        Returns data of all users as a dict of dicts.
+        """
+        return {user_id: user.as_dict() for user_id, user in self.iteritems()}
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Conditional and atomic downloads of data files.
+"""
+import json
+import os
+import socket
+import tempfile
+import time
+import urllib2
+from httplib import HTTPException
+from logging import getLogger
+
+from presence_analyzer.snapshot import file_mode
+
+
+log = getLogger(__name__)  # pylint: disable=invalid-name
+
+CHUNK_SIZE = 64 * 1024
+RETRIED_STATUSES = (408, 429, 500, 502, 503, 504)
+
+
+class DownloadError(Exception):
+    """
+    Raised when file can not be downloaded.
+    """
+
+
+def validators_path(path):
+    """
+    Returns path of file keeping HTTP validators of downloaded file.
+    """
+    return path + '.http'
+
+
+def read_validators(path):
+    """
+    Returns ETag and Last-Modified of file downloaded to given path, empty
+    dict if they are not known or the file does not exist.
+    """
+    if not os.path.exists(path):
+        return {}
+
+    try:
+        with open(validators_path(path)) as validators:
+            return json.load(validators)
+    except (IOError, ValueError):
+        return {}
+
+
+def fetch(url, path, validators, timeout, validate):
+    """
+    Streams url into a temporary file next to path and renames it over path
+    once it is complete and valid, keeping permissions of the old file.
+
+    Returns: (dict) - with validators of the new file, None if the file was
+    not modified.
+    """
+    # pylint: disable=too-many-arguments
+    request = urllib2.Request(url)
+    if validators.get('etag'):
+        request.add_header('If-None-Match', validators['etag'])
+    if validators.get('last_modified'):
+        request.add_header('If-Modified-Since', validators['last_modified'])
+
+    try:
+        response = urllib2.urlopen(request, timeout=timeout)
+    except urllib2.HTTPError as error:
+        if error.code == 304:
+            return None
+        raise
+
+    handle, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)),
+        prefix='.download-'
+    )
+    try:
+        size = 0
+        with os.fdopen(handle, 'wb') as output:
+            for chunk in iter(lambda: response.read(CHUNK_SIZE), b''):
+                output.write(chunk)
+                size += len(chunk)
+        response.close()
+
+        length = response.info().getheader('Content-Length')
+        if length is not None and int(length) != size:
+            raise DownloadError(
+                'Incomplete download: {} of {} bytes'.format(size, length)
+            )
+        if validate is not None:
+            validate(temp_path)
+        os.chmod(temp_path, file_mode(path))
+        os.rename(temp_path, path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+    return {
+        'etag': response.info().getheader('ETag'),
+        'last_modified': response.info().getheader('Last-Modified'),
+    }
+
+
+def download(url, path, timeout=30, retries=3, backoff=1.0, validate=None):
+    """
+    Downloads url to path, unless it did not change since last download.
+
+    The file is replaced atomically, so readers of path see either the old
+    or the complete new file. Optional `validate` is called with path of the
+    downloaded file before it replaces the old one and should raise on
+    invalid data. Failed attempts are retried `retries` times, waiting
+    `backoff` seconds doubled after every attempt. Invalid data is not
+    retried.
+
+    Returns: (bool) - True if the file was updated, False if not modified.
+    """
+    # pylint: disable=too-many-arguments
+    validators = read_validators(path)
+
+    for attempt in range(retries + 1):
+        try:
+            validators = fetch(url, path, validators, timeout, validate)
+            break
+        except urllib2.HTTPError as error:
+            if error.code not in RETRIED_STATUSES or attempt == retries:
+                raise DownloadError(error)
+        except (urllib2.URLError, HTTPException, socket.error,
+                DownloadError) as error:
+            if attempt == retries:
+                raise DownloadError(error)
+        log.warning('Downloading %s failed: %s', url, error)
+        time.sleep(backoff * 2 ** attempt)
+
+    if validators is None:
+        log.info('%s not modified', url)
+        return False
+
+    with open(validators_path(path), 'w') as output:
+        json.dump(validators, output)
+    log.info('Downloaded %s to %s', url, path)
+    return True
@@ -2,3 +2,88 @@
 """
 Helper functions used in templates.
 """
+import gzip
+import os
+from hashlib import sha1
+from logging import getLogger
+
+from flask import url_for
+
+from presence_analyzer.main import app
+
+
+log = getLogger(__name__)  # pylint: disable=invalid-name
+
+COMPRESSED_EXTENSIONS = ('.css', '.html', '.js', '.json', '.svg', '.txt')
+STATIC_MAX_AGE = 365 * 24 * 3600
+
+_static_hashes = {}  # pylint: disable=invalid-name
+
+
+def static_hash(filename):
+    """
+    Returns short hash of contents of a static file, computed once per file.
+    """
+    try:
+        return _static_hashes[filename]
+    except KeyError:
+        pass
+
+    with open(os.path.join(app.static_folder, filename), 'rb') as static:
+        digest = sha1(static.read()).hexdigest()[:12]
+
+    _static_hashes[filename] = digest
+    return digest
+
+
+def static_url(filename):
+    """
+    Returns content-hashed URL of a static file, which can be cached by
+    browsers for a long time, as it changes with contents of the file.
+    """
+    filename = filename.lstrip('/')
+    return url_for('static', filename=filename, v=static_hash(filename))
+
+
+def precompress_static(folder=None):
+    """
+    Writes gzipped copies of compressible static files next to them, unless
+    they are already up to date.
+
+    Returns: (list) - with paths of written files.
+    """
+    folder = folder or app.static_folder
+    written = []
+
+    for directory, _, filenames in os.walk(folder):
+        for filename in filenames:
+            if not filename.endswith(COMPRESSED_EXTENSIONS):
+                continue
+
+            path = os.path.join(directory, filename)
+            compressed = path + '.gz'
+            if os.path.exists(compressed) and \
+                    os.path.getmtime(compressed) >= os.path.getmtime(path):
+                continue
+
+            try:
+                with open(path, 'rb') as static:
+                    data = static.read()
+                with open(compressed + '.tmp', 'wb') as output:
+                    with gzip.GzipFile(filename, 'wb', 9, output, 0) as gz:
+                        gz.write(data)
+                os.rename(compressed + '.tmp', compressed)
+            except (IOError, OSError):
+                log.warning('Can not compress %s', path, exc_info=True)
+                continue
+            written.append(compressed)
+
+    return written
+
+
+@app.context_processor
+def template_helpers():
+    """
+    Makes helpers available in templates.
+    """
+    return {'static_url': static_url}
@@ -0,0 +1,563 @@
+# -*- coding: utf-8 -*-
+"""
+Parsing and incremental loading of the presence export.
+"""
+import marshal
+import os
+from array import array
+from csv import reader
+from datetime import date as datetime_date, time as datetime_time
+from logging import getLogger
+from multiprocessing import Pool
+from threading import Lock, active_count
+
+from presence_analyzer.snapshot import (
+    SnapshotError,
+    read_snapshot,
+    source_digest,
+    write_snapshot,
+)
+from presence_analyzer.store import PresenceStore
+
+
+log = getLogger(__name__)  # pylint: disable=invalid-name
+
+
+DATES_MEMO_SIZE = 100000
+
+_dates_memo = {}  # pylint: disable=invalid-name
+
+
+def parse_date(text):
+    """
+    Parses date in fixed YYYY-MM-DD format of the presence export.
+
+    Thousands of rows share the same day, so already parsed dates are
+    memoized.
+    """
+    try:
+        return _dates_memo[text]
+    except KeyError:
+        pass
+
+    if len(text) != 10 or text[4] != '-' or text[7] != '-':
+        raise ValueError('Invalid date: {!r}'.format(text))
+
+    date = datetime_date(int(text[:4]), int(text[5:7]), int(text[8:]))
+    if len(_dates_memo) >= DATES_MEMO_SIZE:
+        _dates_memo.clear()
+    _dates_memo[text] = date
+
+    return date
+
+
+def parse_seconds(text):
+    """
+    Parses time in fixed HH:MM:SS format into seconds since midnight.
+    """
+    if len(text) != 8 or text[2] != ':' or text[5] != ':':
+        raise ValueError('Invalid time: {!r}'.format(text))
+
+    hour, minute, second = int(text[:2]), int(text[3:5]), int(text[6:])
+    if not (0 <= hour < 24 and 0 <= minute < 60 and 0 <= second < 60):
+        raise ValueError('Invalid time: {!r}'.format(text))
+
+    return hour * 3600 + minute * 60 + second
+
+
+def parse_time(text):
+    """
+    Parses time in fixed HH:MM:SS format into datetime.time object.
+    """
+    if len(text) != 8 or text[2] != ':' or text[5] != ':':
+        raise ValueError('Invalid time: {!r}'.format(text))
+
+    return datetime_time(int(text[:2]), int(text[3:5]), int(text[6:]))
+
+
+AGGREGATES = []
+
+
+def aggregate(cls):
+    """
+    Registers an aggregate built during the single pass over the CSV file.
+
+    Aggregate classes provide a `name` attribute, an `add` method called with
+    every parsed row, a `result` method returning the built structure,
+    a `merge` static method combining results built from consecutive parts
+    of the file and `dumps` and `loads` static methods converting results to
+    and from snapshot sections. Rows are passed as user_id, date, start and
+    end in seconds since midnight and location.
+    """
+    AGGREGATES.append(cls)
+    return cls
+
+
+@aggregate
+class PresenceAggregate(object):
+    """
+    Builds columnar store of presence entries grouped by user_id.
+    """
+    name = 'presence'
+
+    def __init__(self):
+        self.columns = [array(typecode) for typecode in 'iiiiH']
+        self.location_codes = {}
+
+    def add(self, user_id, date, start, end, location):
+        """
+        Stores start and end of presence of given user at given date.
+        """
+        # pylint: disable=too-many-arguments
+        code = self.location_codes.setdefault(
+            location,
+            len(self.location_codes)
+        )
+        user_ids, days, starts, ends, locations = self.columns
+        user_ids.append(user_id)
+        days.append(date.toordinal())
+        starts.append(start)
+        ends.append(end)
+        locations.append(code)
+
+    def result(self):
+        """
+        Returns PresenceStore with presence entries.
+        """
+        names = sorted(self.location_codes, key=self.location_codes.get)
+        return PresenceStore.from_columns(*self.columns + [names])
+
+    @staticmethod
+    def merge(previous, current):
+        """
+        Merges stores, entries of current store win for duplicated days.
+        """
+        return previous.merge(current)
+
+    @staticmethod
+    def dumps(result):
+        """
+        Returns binary representation of the store.
+        """
+        return result.dumps()
+
+    @staticmethod
+    def loads(data):
+        """
+        Creates store from its binary representation.
+        """
+        return PresenceStore.loads(data)
+
+
+@aggregate
+class YearMonthLocationAggregate(object):
+    """
+    Sums presence time by month and location.
+    """
+    name = 'year_month_location'
+
+    def __init__(self):
+        self.data = {}
+
+    def add(self, user_id, date, start, end, location):
+        """
+        Adds presence interval to the total of given month and location.
+        """
+        # pylint: disable=unused-argument, too-many-arguments
+        locations = self.data.setdefault(
+            '{:04d}-{:02d}'.format(date.year, date.month),
+            {}
+        )
+        locations[location] = locations.get(location, 0) + end - start
+
+    def result(self):
+        """
+        Returns presence totals grouped by month and location.
+        """
+        return self.data
+
+    @staticmethod
+    def merge(previous, current):
+        """
+        Sums presence totals of both results.
+        """
+        data = {
+            year_month: dict(locations)
+            for year_month, locations in previous.iteritems()
+        }
+        for year_month, locations in current.iteritems():
+            totals = data.setdefault(year_month, {})
+            for location, total in locations.iteritems():
+                totals[location] = totals.get(location, 0) + total
+        return data
+
+    @staticmethod
+    def dumps(result):
+        """
+        Returns binary representation of presence totals.
+        """
+        return marshal.dumps(result)
+
+    @staticmethod
+    def loads(data):
+        """
+        Creates presence totals from their binary representation.
+        """
+        return marshal.loads(data)
+
+
+def parse_rows(lines):
+    """
+    Parses lines of CSV file into (user_id, date, start, end, location)
+    tuples, skipping header, footer and malformed lines.
+    """
+    for i, row in enumerate(reader(lines, delimiter=',')):
+        if len(row) != 5:
+            # ignore header and footer lines
+            continue
+
+        try:
+            yield (
+                int(row[0]),
+                parse_date(row[1]),
+                parse_seconds(row[2]),
+                parse_seconds(row[3]),
+                row[4],
+            )
+        except (ValueError, TypeError):
+            log.debug('Problem with line %d: ', i, exc_info=True)
+
+
+def filter_rows(rows, since=None, until=None, user_ids=None):
+    """
+    Passes parsed rows of given users from given, inclusive date range.
+    """
+    for row in rows:
+        if since is not None and row[1] < since:
+            continue
+        if until is not None and row[1] > until:
+            continue
+        if user_ids is not None and row[0] not in user_ids:
+            continue
+        yield row
+
+
+def feed(rows, sinks):
+    """
+    Passes every row to all sinks.
+    """
+    for row in rows:
+        for sink in sinks:
+            sink.add(*row)
+    return sinks
+
+
+class LineReader(object):
+    """
+    Iterates over complete lines of file starting at given position and
+    before given end, tracking position after the last returned line.
+    Line without trailing newline ends iteration, as it may be still written.
+    """
+
+    def __init__(self, csvfile, position, end=None):
+        self.csvfile = csvfile
+        self.position = position
+        self.end = end
+
+    def __iter__(self):
+        self.csvfile.seek(self.position)
+        for line in self.csvfile:
+            if not line.endswith('\n'):
+                break
+            self.position += len(line)
+            yield line
+            if self.end is not None and self.position >= self.end:
+                break
+
+
+def split_chunks(csvfile, begin, end, count):
+    """
+    Splits byte range of file into at most `count` ranges starting at line
+    boundaries.
+    """
+    bounds = [begin]
+
+    for i in range(1, count):
+        csvfile.seek(begin + (end - begin) * i // count)
+        csvfile.readline()
+        bounds.append(min(max(csvfile.tell(), bounds[-1]), end))
+    bounds.append(end)
+
+    return [
+        (start, stop) for start, stop in zip(bounds, bounds[1:])
+        if start < stop
+    ]
+
+
+def parse_chunk(task):
+    """
+    Builds aggregates from lines of file starting in given byte range.
+
+    Runs in worker processes, so results are returned in their binary
+    representation along with position after the last complete line.
+    """
+    path, begin, end, aggregates = task
+
+    with open(path, 'rb') as csvfile:
+        lines = LineReader(csvfile, begin, end)
+        items = feed(parse_rows(lines), [cls() for cls in aggregates])
+
+    return (
+        {item.name: item.dumps(item.result()) for item in items},
+        lines.position,
+    )
+
+
+def parse_parallel(path, begin, end, aggregates, workers):
+    """
+    Parses byte range of file in chunks in a pool of worker processes.
+
+    Returns: (tuple) - with list of results of every chunk, in order of
+    chunks, and position after the last complete line.
+    """
+    with open(path, 'rb') as csvfile:
+        chunks = split_chunks(csvfile, begin, end, workers)
+
+    pool = Pool(workers)
+    try:
+        parts = pool.map(
+            parse_chunk,
+            [(path, start, stop, aggregates) for start, stop in chunks]
+        )
+    finally:
+        pool.close()
+        pool.join()
+
+    results = [
+        {cls.name: cls.loads(part[cls.name]) for cls in aggregates}
+        for part, _ in parts
+    ]
+    return results, parts[-1][1] if parts else begin
+
+
+def stream_csv(path, sinks, since=None, until=None, user_ids=None):
+    """
+    Feeds rows of CSV file to sinks in a single streaming pass.
+
+    Lines are read, parsed, filtered and aggregated one at a time, so only
+    sinks keep state and memory does not grow with size of the file.
+
+    Returns: (list) - with results of sinks.
+    """
+    # pylint: disable=too-many-arguments
+    with open(path, 'rb') as csvfile:
+        rows = filter_rows(parse_rows(csvfile), since, until, user_ids)
+        feed(rows, sinks)
+
+    return [sink.result() for sink in sinks]
+
+
+class CSVLoader(object):
+    """
+    Builds aggregates from the append-only presence export.
+
+    The loader remembers how far the file was read, with digest of the read
+    part, and on the following loads parses only appended lines, merging
+    them into previous results. The file is read from the beginning again
+    when it is replaced, truncated or rewritten in place, which changes the
+    digest. Last line without trailing newline may be still written, so it
+    is parsed on every load into returned results, but it is never merged
+    into results the loader keeps and the position stays before it.
+
+    When snapshot path is given, results are saved to it after each change
+    and a fresh loader starts from the snapshot when the part of the file it
+    was built from is unchanged.
+
+    With more than one worker, reads larger than parallel_size bytes are
+    split into chunks parsed in a pool of processes. Forking is unsafe while
+    other threads run, as children may inherit locks they hold, so the pool
+    is used only when the loading thread is the only one, as in
+    `refresh_data` or synchronous warm-up, and lines are parsed in process
+    otherwise.
+    """
+    parallel_size = 1024 * 1024
+
+    def __init__(self, aggregates):
+        self.aggregates = aggregates
+        self.path = None
+        self.inode = None
+        self.digest = None
+        self.position = 0
+        self.results = None
+        self.generation = 0
+        self.lock = Lock()
+
+    def load(self, path, snapshot_path=None, workers=1):
+        """
+        Returns results of aggregates, keyed by aggregate name.
+
+        Loads are serialized, as the loader is shared by request,
+        warm-up and refresh threads.
+        """
+        with self.lock:
+            with open(path, 'rb') as csvfile:
+                stat = os.fstat(csvfile.fileno())
+                if self.results is None and snapshot_path is not None:
+                    self.restore(snapshot_path, path, csvfile, stat)
+
+                if not self.is_appended(path, stat, csvfile):
+                    log.debug('Loading %s from the beginning', path)
+                    self.position = 0
+                    self.results = None
+                elif stat.st_size == self.position:
+                    return self.results
+
+                if workers > 1 and active_count() > 1:
+                    log.debug('Parsing %s in process, other threads run',
+                              path)
+                    workers = 1
+                if workers > 1 and \
+                        stat.st_size - self.position > self.parallel_size:
+                    parts, position = parse_parallel(
+                        path, self.position, stat.st_size, self.aggregates,
+                        workers
+                    )
+                else:
+                    lines = LineReader(csvfile, self.position)
+                    parts = [self.parse(lines)]
+                    position = lines.position
+
+                if self.results is None or position != self.position:
+                    results = self.results
+                    for part in parts:
+                        results = self.merge(results, part)
+
+                    self.path = path
+                    self.inode = stat.st_ino
+                    self.position = position
+                    self.digest = source_digest(csvfile, position)
+                    self.results = results
+
+                    if snapshot_path is not None:
+                        self.save(snapshot_path)
+
+                if position == stat.st_size:
+                    return self.results
+
+                csvfile.seek(position)
+                return self.merge(self.results, self.parse([csvfile.read()]))
+
+    def parse(self, lines):
+        """
+        Returns results of aggregates built from given lines.
+        """
+        aggregates = feed(
+            parse_rows(lines),
+            [cls() for cls in self.aggregates]
+        )
+        return {item.name: item.result() for item in aggregates}
+
+    def merge(self, results, part):
+        """
+        Returns results merged with results of the following part of file.
+        """
+        if results is None:
+            return part
+        return {
+            cls.name: cls.merge(results[cls.name], part[cls.name])
+            for cls in self.aggregates
+        }
+
+    def is_appended(self, path, stat, csvfile):
+        """
+        Checks if file was only appended to since the previous load.
+        """
+        return (
+            self.results is not None and
+            path == self.path and
+            stat.st_ino == self.inode and
+            stat.st_size >= self.position and
+            source_digest(csvfile, self.position) == self.digest
+        )
+
+    def restore(self, snapshot_path, path, csvfile, stat):
+        """
+        Restores results from snapshot if it was built from the current
+        beginning of the file.
+        """
+        try:
+            header, sections = read_snapshot(snapshot_path)
+            position = header['position']
+            if position > stat.st_size or \
+                    header['digest'] != source_digest(csvfile, position):
+                raise SnapshotError('Snapshot of different file')
+            results = {
+                cls.name: cls.loads(sections[cls.name])
+                for cls in self.aggregates
+            }
+        except (IOError, OSError, KeyError, ValueError, SnapshotError):
+            log.info('Snapshot %s not used', snapshot_path, exc_info=True)
+            return
+
+        self.path = path
+        self.inode = stat.st_ino
+        self.digest = header['digest']
+        self.position = position
+        self.results = results
+        self.generation = header.get('generation', 0)
+        log.info('Restored %s from snapshot', path)
+
+    def save(self, snapshot_path):
+        """
+        Writes results to snapshot.
+        """
+        try:
+            write_snapshot(
+                snapshot_path,
+                {
+                    'position': self.position,
+                    'digest': self.digest,
+                    'generation': self.generation + 1,
+                },
+                [
+                    (cls.name, cls.dumps(self.results[cls.name]))
+                    for cls in self.aggregates
+                ]
+            )
+        except (IOError, OSError):
+            log.exception('Writing snapshot %s failed', snapshot_path)
+        else:
+            self.generation += 1
+
+
+class SnapshotLoader(object):
+    """
+    Attaches read-only to aggregates published in snapshot by a separate
+    loader process.
+
+    Snapshots are replaced atomically, so requests being served keep using
+    the mapping of the previous generation until they finish.
+    """
+
+    def __init__(self, aggregates):
+        self.aggregates = aggregates
+        self.generation = None
+        self.results = None
+
+    def load(self, snapshot_path):
+        """
+        Returns results of aggregates from the latest snapshot.
+        """
+        header, sections = read_snapshot(snapshot_path)
+        if header.get('generation') != self.generation:
+            self.results = {
+                cls.name: cls.loads(sections[cls.name])
+                for cls in self.aggregates
+            }
+            self.generation = header.get('generation')
+            log.info(
+                'Attached to snapshot %s, generation %s',
+                snapshot_path,
+                self.generation
+            )
+        return self.results
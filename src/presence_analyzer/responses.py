@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+Conditional, cached and compressed responses of views.
+"""
+import gzip
+from collections import OrderedDict
+from cStringIO import StringIO
+from datetime import datetime
+from functools import wraps
+from hashlib import sha1
+from threading import Lock
+
+from flask import Response, request
+from werkzeug.http import is_resource_modified
+
+from presence_analyzer.main import app
+
+
+COMPRESS_MIN_SIZE = 512
+COMPRESS_LEVEL = 6
+
+
+def accepts_gzip():
+    """
+    Checks if client of the current request accepts gzip encoding.
+    """
+    return request.accept_encodings['gzip'] > 0
+
+
+def gzip_compress(data):
+    """
+    Compresses data with gzip, without a timestamp in the header.
+    """
+    output = StringIO()
+    with gzip.GzipFile('', 'wb', COMPRESS_LEVEL, output, 0) as compressed:
+        compressed.write(data)
+    return output.getvalue()
+
+
+@app.after_request
+def compress_response(response):
+    """
+    Compresses JSON responses for clients accepting gzip encoding.
+    """
+    if response.mimetype != 'application/json':
+        return response
+
+    response.vary.add('Accept-Encoding')
+    if response.status_code == 200 and not response.content_encoding and \
+            not response.direct_passthrough and accepts_gzip():
+        data = response.get_data()
+        if len(data) >= COMPRESS_MIN_SIZE:
+            response.set_data(gzip_compress(data))
+            response.content_encoding = 'gzip'
+
+    return response
+
+
+class ResponseCache(object):
+    """
+    Least recently used cache of encoded response bodies keyed by ETag.
+
+    ETags change with versions of the data responses are built from, so
+    entries of outdated data are never hit again and get evicted.
+
+    Cache keeps at most maxsize entries of maxbytes bytes in total. Bodies
+    larger than an eighth of maxbytes are not cached, so a few large
+    responses can not flush all other entries.
+    """
+
+    def __init__(self, maxsize, maxbytes):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+
+    def get(self, etag):
+        """
+        Returns (body, content_encoding, mimetype) tuple cached under given
+        ETag, or None.
+        """
+        with self.lock:
+            entry = self.entries.pop(etag, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries[etag] = entry
+            return entry
+
+    def set(self, etag, body, content_encoding, mimetype):
+        """
+        Caches response body, evicting least recently used entries.
+        """
+        if len(body) > self.maxbytes // 8:
+            return
+
+        with self.lock:
+            previous = self.entries.pop(etag, None)
+            if previous is not None:
+                self.bytes -= len(previous[0])
+            self.entries[etag] = (body, content_encoding, mimetype)
+            self.bytes += len(body)
+
+            while len(self.entries) > self.maxsize or \
+                    self.bytes > self.maxbytes:
+                _, entry = self.entries.popitem(last=False)
+                self.bytes -= len(entry[0])
+
+    def clear(self):
+        """
+        Drops all cached entries.
+        """
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        """
+        Returns usage metrics.
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self.entries),
+            'bytes': self.bytes,
+        }
+
+
+RESPONSE_CACHE_SIZE = 4096
+RESPONSE_CACHE_BYTES = 64 * 1024 * 1024
+
+response_cache = ResponseCache(  # pylint: disable=invalid-name
+    RESPONSE_CACHE_SIZE,
+    RESPONSE_CACHE_BYTES
+)
+
+
+def get_datasets_version(datasets):
+    """
+    Loads given cached datasets and returns versions of data cached by them
+    with the latest modification time of their source files, if known.
+    """
+    versions = []
+    mtimes = []
+
+    for function in datasets:
+        function()
+        version = function.cache.version()
+        versions.append(version)
+        if isinstance(version, tuple):
+            mtimes.extend(source[3] for source in version if len(source) == 4)
+
+    if not mtimes:
+        return versions, None
+    return versions, datetime.utcfromtimestamp(int(max(mtimes)))
+
+
+def conditional(*datasets):
+    """
+    Decorator that answers conditional GET requests with 304 Not Modified
+    and serves other requests from the response cache.
+
+    Strong ETag of the response is derived from versions of given cached
+    datasets, the request path with query string and accepted encoding, so
+    If-None-Match and If-Modified-Since are checked before the wrapped view
+    is called. Bodies of successful responses are cached under the ETag,
+    already compressed, so the view is called once per request path and
+    version of the data.
+    """
+    def decorator(function):
+        """
+        Returns decorated view.
+        """
+        @wraps(function)
+        def inner(*args, **kwargs):
+            """
+            This docstring will be overridden by @wraps decorator.
+            """
+            versions, last_modified = get_datasets_version(datasets)
+            etag = sha1(repr(
+                (versions, request.full_path, accepts_gzip())
+            ).encode('utf-8')).hexdigest()
+
+            if not is_resource_modified(request.environ, etag,
+                                        last_modified=last_modified):
+                response = Response(status=304)
+            else:
+                cached = response_cache.get(etag)
+                if cached is not None:
+                    response = Response(cached[0], mimetype=cached[2])
+                    if cached[1]:
+                        response.content_encoding = cached[1]
+                else:
+                    response = compress_response(function(*args, **kwargs))
+                    if response.status_code == 200:
+                        response_cache.set(
+                            etag, response.get_data(),
+                            response.content_encoding, response.mimetype
+                        )
+
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            response.vary.add('Accept-Encoding')
+            response.cache_control.no_cache = True
+            return response
+        return inner
+    return decorator
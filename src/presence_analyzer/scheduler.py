@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Background refresh of cached datasets.
+"""
+import random
+from datetime import datetime, timedelta
+from logging import getLogger
+from threading import Event, Thread
+
+
+log = getLogger(__name__)  # pylint: disable=invalid-name
+
+MODES = ('interval', 'watch')
+
+
+class Scheduler(object):
+    """
+    Refreshes cached datasets in a background thread, so that requests only
+    read data which is already built.
+
+    In 'interval' mode datasets are rebuilt every `interval` seconds, in
+    'watch' mode their source files are checked every `watch_interval`
+    seconds and datasets are rebuilt when the files change. Delays are
+    randomly spread by `jitter` fraction and grow exponentially up to
+    `max_backoff` seconds while refreshes fail.
+    """
+    # pylint: disable=too-many-instance-attributes, too-many-arguments
+
+    def __init__(self, datasets, interval=60, watch_interval=1, jitter=0.1,
+                 max_backoff=600):
+        self.datasets = datasets
+        self.interval = interval
+        self.watch_interval = watch_interval
+        self.jitter = jitter
+        self.max_backoff = max_backoff
+        self.mode = None
+        self.failures = 0
+        self.runs = 0
+        self.last_run = None
+        self.next_run = None
+        self.results = {}
+        self.stopping = Event()
+        self.thread = None
+
+    def delay(self):
+        """
+        Returns seconds to wait before next run.
+        """
+        if self.mode == 'watch':
+            delay = self.watch_interval
+        else:
+            delay = self.interval
+        if self.failures:
+            delay = min(delay * 2 ** self.failures, self.max_backoff)
+
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def run_once(self):
+        """
+        Refreshes all datasets, rebuilding them in 'interval' mode and only
+        outdated ones in 'watch' mode.
+
+        Returns: (bool) - True if all datasets were refreshed successfully.
+        """
+        self.runs += 1
+        self.last_run = datetime.now()
+        success = True
+
+        for function in self.datasets:
+            started = datetime.now()
+            result = self.results.setdefault(function.__name__, {
+                'last_refresh': None,
+                'last_error': None,
+                'duration': None,
+            })
+            try:
+                if function.refresh(force=self.mode != 'watch'):
+                    result['last_refresh'] = datetime.now().isoformat()
+            except Exception as error:  # pylint: disable=broad-except
+                log.exception('Scheduled refresh of %s failed',
+                              function.__name__)
+                result['last_error'] = '{}: {}'.format(
+                    type(error).__name__, error
+                )
+                success = False
+            result['duration'] = (datetime.now() - started).total_seconds()
+
+        self.failures = 0 if success else self.failures + 1
+        return success
+
+    def loop(self):
+        """
+        Runs refreshes until stopped.
+        """
+        while True:
+            delay = self.delay()
+            self.next_run = datetime.now() + timedelta(seconds=delay)
+            if self.stopping.wait(delay):
+                break
+            self.run_once()
+
+    def start(self, mode):
+        """
+        Starts refreshing datasets in given mode, 'interval' or 'watch'.
+        Requests stop revalidating cached data, which is left to the
+        scheduler.
+        """
+        if mode not in MODES:
+            raise ValueError('Unknown scheduler mode: {!r}'.format(mode))
+        if self.thread is not None:
+            return
+
+        self.mode = mode
+        self.stopping.clear()
+        for function in self.datasets:
+            function.cache.scheduled = True
+
+        self.thread = Thread(target=self.loop, name='scheduler')
+        self.thread.daemon = True
+        self.thread.start()
+        log.info('Scheduler started in %s mode', mode)
+
+    def stop(self):
+        """
+        Stops the scheduler and lets requests revalidate cached data again.
+        """
+        if self.thread is None:
+            return
+
+        self.stopping.set()
+        self.thread.join()
+        self.thread = None
+        self.next_run = None
+        for function in self.datasets:
+            function.cache.scheduled = False
+
+    def status(self):
+        """
+        Returns state of the scheduler and results of refreshes.
+        """
+        return {
+            'mode': self.mode if self.thread is not None else None,
+            'runs': self.runs,
+            'failures': self.failures,
+            'last_run': self.last_run.isoformat() if self.last_run else None,
+            'next_run': self.next_run.isoformat() if self.next_run else None,
+            'datasets': self.results,
+        }
@@ -4,12 +4,15 @@
 
 import os
 import sys
+import time
 from functools import partial
-from urllib2 import urlopen
+from logging import getLogger
 
 import paste.script.command
 import werkzeug.script
 
+log = getLogger(__name__)
+
 etc = partial(os.path.join, 'parts', 'etc')
 
 DEPLOY_INI = etc('deploy.ini')
@@ -27,10 +30,16 @@ del _buildout_path
 
 
 # bin/paster serve parts/etc/deploy.ini
-def make_app(global_conf={}, config=DEPLOY_CFG, debug=False):
+def make_app(global_conf={}, config=DEPLOY_CFG, debug=False, warm_up=True):
     from presence_analyzer import app
+    from presence_analyzer.helpers import precompress_static
+    from presence_analyzer.utils import start_scheduler, start_warm_up
     app.config.from_pyfile(abspath(config))
     app.debug = debug
+    precompress_static()
+    if warm_up:
+        start_warm_up(app.config.get('WARM_UP'))
+        start_scheduler(app.config.get('SCHEDULER'))
     return app
 
 
@@ -119,8 +128,54 @@ def update_user_data():
     """
     Gets data from the app.config['URL_FOR_XML']
     and saves it in the file app.config['DATA_XML'].
+
+    The file is replaced atomically and only when it changed, so the running
+    app notices the new file and reloads users in the background.
     """
-    app = make_app()
+    from presence_analyzer.directory import UserDirectory
+    from presence_analyzer.download import download
+    app = make_app(warm_up=False)
+
+    download(
+        app.config['URL_FOR_XML'],
+        app.config['DATA_XML'],
+        timeout=app.config.get('DOWNLOAD_TIMEOUT', 30),
+        retries=app.config.get('DOWNLOAD_RETRIES', 3),
+        validate=UserDirectory.parse,
+    )
 
-    with open(app.config['DATA_XML'], 'wb') as xml_users:
-        xml_users.write(urlopen(app.config['URL_FOR_XML']).read())
+
+# bin/refresh_data [--once]
+def refresh_data():
+    """
+    Publishes aggregates from app.config['DATA_CSV'] in the snapshot
+    app.config['DATA_SNAPSHOT'] read by workers running with
+    DATA_PLANE = "shared", every app.config['REFRESH_INTERVAL'] seconds.
+
+    Failed refreshes are logged and retried with the delay doubled after
+    each failure, up to app.config['REFRESH_MAX_BACKOFF'] seconds. With
+    --once failures are raised.
+    """
+    from presence_analyzer.utils import refresh_snapshot
+    app = make_app(warm_up=False)
+    interval = app.config.get('REFRESH_INTERVAL', 60)
+    max_backoff = app.config.get('REFRESH_MAX_BACKOFF', 600)
+    failures = 0
+
+    while True:
+        try:
+            refresh_snapshot()
+        except Exception:
+            if '--once' in sys.argv:
+                raise
+            failures += 1
+            log.exception('Refresh of snapshot failed (%d in a row)',
+                          failures)
+        else:
+            failures = 0
+        if '--once' in sys.argv:
+            break
+        delay = interval
+        if failures:
+            delay = min(delay * 2 ** failures, max_backoff)
+        time.sleep(delay)
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Binary snapshots of data built from the presence export.
+
+Snapshot file starts with MAGIC, followed by named sections aligned to
+ALIGNMENT bytes, JSON header describing them and offset of the header
+packed as little-endian unsigned long long.
+"""
+import json
+import mmap
+import os
+import stat
+import struct
+import sys
+import tempfile
+from hashlib import sha1
+
+
+MAGIC = 'PRESNAP\0'
+VERSION = 1
+ALIGNMENT = 8
+DIGEST_SIZE = 4096
+TRAILER = struct.Struct('<Q')
+
+
+class SnapshotError(Exception):
+    """
+    Raised when snapshot can not be used.
+    """
+
+
+def align(offset):
+    """
+    Rounds offset up to the snapshot's alignment.
+    """
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def source_digest(source, position):
+    """
+    Returns digest of the beginning and the end of first `position` bytes
+    of source file, which are expected not to change in append-only file.
+    """
+    digest = sha1()
+    size = min(DIGEST_SIZE, position)
+
+    source.seek(0)
+    digest.update(source.read(size))
+    source.seek(position - size)
+    digest.update(source.read(size))
+
+    return digest.hexdigest()
+
+
+def file_mode(path):
+    """
+    Returns permissions of file at path, or permissions of new files under
+    the current umask if it does not exist.
+    """
+    try:
+        return stat.S_IMODE(os.stat(path).st_mode)
+    except OSError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
+
+
+def write_snapshot(path, header, sections):
+    """
+    Atomically writes snapshot with given header and list of
+    (name, bytes) sections, keeping permissions of the replaced file, so
+    processes of other users can still read it.
+    """
+    handle, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)),
+        prefix='.snapshot-'
+    )
+    try:
+        with os.fdopen(handle, 'wb') as output:
+            output.write(MAGIC)
+            layout = []
+            for name, data in sections:
+                offset = align(output.tell())
+                output.write('\0' * (offset - output.tell()))
+                output.write(data)
+                layout.append([name, offset, len(data)])
+
+            header = dict(
+                header,
+                version=VERSION,
+                byteorder=sys.byteorder,
+                sections=layout,
+            )
+            offset = output.tell()
+            output.write(json.dumps(header))
+            output.write(TRAILER.pack(offset))
+        os.chmod(temp_path, file_mode(path))
+        os.rename(temp_path, path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+
+def read_snapshot(path):
+    """
+    Maps snapshot into memory.
+
+    Returns: (tuple) - with header and dict of read-only buffers over the
+    mapped sections, like:
+    (
+        {'version': 1, 'byteorder': 'little', ...},
+        {'presence': <read-only buffer>, ...},
+    )
+    """
+    with open(path, 'rb') as snapshot:
+        try:
+            data = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error) as error:
+            raise SnapshotError(error)
+
+    if len(data) < len(MAGIC) + TRAILER.size or \
+            data[:len(MAGIC)] != MAGIC:
+        raise SnapshotError('Invalid snapshot: {}'.format(path))
+
+    offset, = TRAILER.unpack(data[-TRAILER.size:])
+    try:
+        header = json.loads(data[offset:-TRAILER.size])
+    except ValueError as error:
+        raise SnapshotError(error)
+
+    if header.get('version') != VERSION or \
+            header.get('byteorder') != sys.byteorder:
+        raise SnapshotError('Incompatible snapshot: {}'.format(path))
+
+    sections = {
+        name: buffer(data, offset, length)
+        for name, offset, length in header['sections']
+    }
+    return header, sections
@@ -0,0 +1,553 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar storage of presence data.
+"""
+import marshal
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import date as datetime_date, time as datetime_time
+from itertools import izip
+
+from presence_analyzer import vectorized
+from presence_analyzer.snapshot import align
+
+
+META_SIZE = struct.Struct('<I')
+
+
+def seconds_to_time(seconds):
+    """
+    Converts seconds since midnight to datetime.time object.
+    """
+    return datetime_time(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def ordinal_weekday(day):
+    """
+    Returns weekday of a proleptic Gregorian ordinal, Monday is 0.
+    """
+    return (day - 1) % 7
+
+
+EMPTY_WEEKDAYS = [(0, 0, 0, 0)] * 7
+
+
+def sum_by_weekday(days, starts, ends, begin, end):
+    """
+    Sums entries in given range of arrays by weekday.
+
+    Returns: (list) - with (count, intervals, starts, ends) sums for every
+    weekday, Monday first.
+    """
+    # pylint: disable=too-many-arguments
+    result = [[0, 0, 0, 0] for _ in range(7)]
+
+    for i in xrange(begin, end):
+        start, stop = starts[i], ends[i]
+        totals = result[(days[i] - 1) % 7]
+        totals[0] += 1
+        totals[1] += stop - start
+        totals[2] += start
+        totals[3] += stop
+
+    return [tuple(totals) for totals in result]
+
+
+def month_number(year_month):
+    """
+    Converts month in YYYY-MM format to number of months since year 0.
+    """
+    if len(year_month) != 7 or year_month[4] != '-':
+        raise ValueError('Invalid month: {!r}'.format(year_month))
+
+    year, month = int(year_month[:4]), int(year_month[5:])
+    if not 1 <= month <= 12:
+        raise ValueError('Invalid month: {!r}'.format(year_month))
+    return year * 12 + month - 1
+
+
+def format_month(number):
+    """
+    Converts number of months since year 0 to month in YYYY-MM format.
+    """
+    return '{:04d}-{:02d}'.format(number // 12, number % 12 + 1)
+
+
+class LocationIndex(object):
+    """
+    Prefix sums of presence time by location over consecutive months.
+
+    Totals of any range of months are differences of two prefix sums for
+    every location, so they do not depend on length of the range.
+    """
+
+    def __init__(self, totals):
+        """
+        Builds index of totals like get_year_month_location.
+        """
+        months = sorted(month_number(key) for key in totals)
+        self.first = months[0] if months else 0
+        self.size = months[-1] - self.first + 1 if months else 0
+        self.sums = {}
+
+        for year_month, locations in totals.iteritems():
+            position = month_number(year_month) - self.first + 1
+            for name, seconds in locations.iteritems():
+                if name not in self.sums:
+                    self.sums[name] = array('l', [0]) * (self.size + 1)
+                self.sums[name][position] += seconds
+
+        for sums in self.sums.itervalues():
+            for position in xrange(1, self.size + 1):
+                sums[position] += sums[position - 1]
+
+    def totals(self, since=None, until=None):
+        """
+        Returns presence time by location between given month numbers,
+        inclusive, like:
+        {
+            'Pila': 3028793,
+            'Lodz': 2823194,
+        }
+        """
+        low = 0 if since is None else since - self.first
+        high = self.size if until is None else until - self.first + 1
+        low = min(max(low, 0), self.size)
+        high = min(max(high, low), self.size)
+
+        return {
+            name: sums[high] - sums[low]
+            for name, sums in self.sums.iteritems()
+            if sums[high] != sums[low]
+        }
+
+
+class MappedColumn(object):
+    """
+    Read-only, array-like view of a column stored in a buffer.
+    """
+    __slots__ = ('typecode', 'itemsize', 'data', 'offset', 'length', 'item')
+
+    def __init__(self, typecode, data, offset, length):
+        # pylint: disable=too-many-arguments
+        self.typecode = typecode
+        self.itemsize = array(typecode).itemsize
+        self.data = data
+        self.offset = offset
+        self.length = length
+        self.item = struct.Struct(typecode)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, _ = key.indices(self.length)
+            column = array(self.typecode)
+            column.fromstring(buffer(
+                self.data,
+                self.offset + start * self.itemsize,
+                max(stop - start, 0) * self.itemsize
+            ))
+            return column
+
+        if key < 0:
+            key += self.length
+        if not 0 <= key < self.length:
+            raise IndexError('column index out of range')
+        return self.item.unpack_from(
+            self.data,
+            self.offset + key * self.itemsize
+        )[0]
+
+    def __iter__(self):
+        return iter(self[:])
+
+    def tostring(self):
+        """
+        Returns column as a string of machine values.
+        """
+        return str(buffer(self.data, self.offset, self.length * self.itemsize))
+
+
+class PresenceStore(object):
+    """
+    Compact, read-only storage of presence entries.
+
+    Entries are kept in parallel arrays sorted by user_id and day. Days are
+    proleptic Gregorian ordinals, starts and ends are seconds since midnight
+    and locations are codes into `location_names`. The `index` maps user_id
+    to the slice of arrays holding entries of that user and `weekdays` maps
+    user_id to precomputed per-weekday totals. Per-weekday date indexes of
+    users are built on first date range query and kept in `date_indexes`,
+    month indexes of locations in `location_indexes`.
+    """
+    # pylint: disable=too-many-instance-attributes, too-many-arguments
+
+    def __init__(self, user_ids, days, starts, ends, locations,
+                 location_names, index, weekdays):
+        self.user_ids = user_ids
+        self.days = days
+        self.starts = starts
+        self.ends = ends
+        self.locations = locations
+        self.location_names = location_names
+        self.index = index
+        self.weekdays = weekdays
+        self.date_indexes = {}
+        self.location_indexes = {}
+
+    @classmethod
+    def from_columns(cls, user_ids, days, starts, ends, locations,
+                     location_names):
+        """
+        Builds store from parallel arrays of entries in arbitrary order.
+
+        Arrays already sorted by user_id and day are used as they are,
+        otherwise entries are sorted and for duplicated days of a user the
+        last entry wins.
+        """
+        size = len(days)
+        ordered = all(
+            (user_ids[i - 1], days[i - 1]) < (user_ids[i], days[i])
+            for i in xrange(1, size)
+        )
+
+        if not ordered:
+            order = sorted(xrange(size), key=lambda i: (user_ids[i], days[i]))
+            order = [
+                i for n, i in enumerate(order)
+                if n + 1 == size or
+                (user_ids[i], days[i]) != (
+                    user_ids[order[n + 1]], days[order[n + 1]]
+                )
+            ]
+            user_ids, days, starts, ends, locations = [
+                array(column.typecode, (column[i] for i in order))
+                for column in (user_ids, days, starts, ends, locations)
+            ]
+
+        index = {}
+        begin = 0
+        while begin < len(user_ids):
+            user_id = user_ids[begin]
+            end = bisect_right(user_ids, user_id, begin)
+            index[user_id] = (begin, end)
+            begin = end
+
+        if vectorized.is_available():
+            weekdays = vectorized.weekday_totals(
+                user_ids, days, starts, ends, index
+            )
+        else:
+            weekdays = {
+                user_id: sum_by_weekday(days, starts, ends, begin, end)
+                for user_id, (begin, end) in index.iteritems()
+            }
+
+        return cls(
+            user_ids, days, starts, ends, locations, location_names, index,
+            weekdays
+        )
+
+    def merge(self, other):
+        """
+        Returns new store with entries of both stores.
+
+        Entries of `other` win for duplicated days of a user. Users whose new
+        entries all follow their existing ones, which is the case for rows
+        appended to the presence export, are merged by copying array slices.
+        """
+        # pylint: disable=too-many-locals
+        location_names = list(self.location_names)
+        codes = {name: code for code, name in enumerate(location_names)}
+        for name in other.location_names:
+            if name not in codes:
+                codes[name] = len(location_names)
+                location_names.append(name)
+        remap = [codes[name] for name in other.location_names]
+
+        columns = [
+            array(column.typecode)
+            for column in (
+                self.user_ids, self.days, self.starts, self.ends,
+                self.locations,
+            )
+        ]
+        user_ids, days, starts, ends, locations = columns
+        index = {}
+        weekdays = {}
+
+        for user_id in sorted(set(self.index) | set(other.index)):
+            begin = len(days)
+            old_begin, old_end = self.index.get(user_id, (0, 0))
+            new_begin, new_end = other.index.get(user_id, (0, 0))
+            appended = (
+                old_begin == old_end or new_begin == new_end or
+                self.days[old_end - 1] < other.days[new_begin]
+            )
+
+            if appended:
+                self._copy_to(columns, old_begin, old_end)
+                other._copy_to(columns, new_begin, new_end, remap)
+            else:
+                entries = {}
+                for i in xrange(old_begin, old_end):
+                    entries[self.days[i]] = (
+                        self.starts[i], self.ends[i], self.locations[i]
+                    )
+                for i in xrange(new_begin, new_end):
+                    entries[other.days[i]] = (
+                        other.starts[i], other.ends[i],
+                        remap[other.locations[i]]
+                    )
+                for day in sorted(entries):
+                    user_ids.append(user_id)
+                    days.append(day)
+                    starts.append(entries[day][0])
+                    ends.append(entries[day][1])
+                    locations.append(entries[day][2])
+
+            index[user_id] = (begin, len(days))
+            if appended:
+                weekdays[user_id] = [
+                    tuple(a + b for a, b in zip(old, new))
+                    for old, new in zip(
+                        self.weekday_totals(user_id),
+                        other.weekday_totals(user_id)
+                    )
+                ]
+            else:
+                weekdays[user_id] = sum_by_weekday(
+                    days, starts, ends, begin, len(days)
+                )
+
+        return PresenceStore(
+            user_ids, days, starts, ends, locations, location_names, index,
+            weekdays
+        )
+
+    def _copy_to(self, columns, begin, end, remap=None):
+        """
+        Appends given range of entries to columns, optionally translating
+        location codes.
+        """
+        user_ids, days, starts, ends, locations = columns
+        user_ids.extend(self.user_ids[begin:end])
+        days.extend(self.days[begin:end])
+        starts.extend(self.starts[begin:end])
+        ends.extend(self.ends[begin:end])
+        if remap is None:
+            locations.extend(self.locations[begin:end])
+        else:
+            locations.extend(remap[code] for code in self.locations[begin:end])
+
+    def columns(self):
+        """
+        Returns list of parallel arrays.
+        """
+        return [
+            self.user_ids, self.days, self.starts, self.ends, self.locations,
+        ]
+
+    def dumps(self):
+        """
+        Returns binary representation of the store.
+
+        Size of marshalled metadata is followed by metadata and raw arrays,
+        each aligned so that arrays can be read from mapped snapshot.
+        """
+        columns = self.columns()
+        meta = marshal.dumps((
+            self.location_names,
+            self.index,
+            self.weekdays,
+            [(column.typecode, len(column)) for column in columns],
+        ))
+        chunks = [META_SIZE.pack(len(meta)), meta]
+        offset = META_SIZE.size + len(meta)
+
+        for column in columns:
+            chunks.append('\0' * (align(offset) - offset))
+            chunks.append(column.tostring())
+            offset = align(offset) + len(chunks[-1])
+
+        return ''.join(chunks)
+
+    @classmethod
+    def loads(cls, data):
+        """
+        Creates store from its binary representation.
+
+        Arrays are not copied, the store reads them from `data`, which is
+        usually a buffer over mapped snapshot shared by all processes.
+        """
+        size, = META_SIZE.unpack_from(data)
+        location_names, index, weekdays, layout = marshal.loads(
+            data[META_SIZE.size:META_SIZE.size + size]
+        )
+        offset = META_SIZE.size + size
+        columns = []
+
+        for typecode, length in layout:
+            offset = align(offset)
+            column = MappedColumn(typecode, data, offset, length)
+            columns.append(column)
+            offset += length * column.itemsize
+
+        return cls(*columns + [location_names, index, weekdays])
+
+    def __contains__(self, user_id):
+        return user_id in self.index
+
+    def __len__(self):
+        return len(self.days)
+
+    def users(self):
+        """
+        Returns sorted list of user ids.
+        """
+        return sorted(self.index)
+
+    def entries(self, user_id):
+        """
+        Yields (day, start, end, location) tuples of given user sorted by day.
+        """
+        begin, end = self.index.get(user_id, (0, 0))
+        names = self.location_names
+
+        for day, start, stop, code in izip(self.days[begin:end],
+                                           self.starts[begin:end],
+                                           self.ends[begin:end],
+                                           self.locations[begin:end]):
+            yield day, start, stop, names[code]
+
+    def date_index(self, user_id):
+        """
+        Returns index of entries of given user for every weekday, with
+        sorted days and prefix sums of intervals, starts and ends, like:
+        [
+            (
+                array('i', [735142, 735149]),
+                array('l', [0, 28800, 57600]),
+                array('l', [0, 32400, 64800]),
+                array('l', [0, 61200, 122400]),
+            ),
+            ...
+        ]
+        """
+        index = self.date_indexes.get(user_id)
+        if index is not None:
+            return index
+
+        begin, end = self.index.get(user_id, (0, 0))
+        index = [
+            (array('i'), array('l', [0]), array('l', [0]), array('l', [0]))
+            for _ in range(7)
+        ]
+        for day, start, stop in izip(self.days[begin:end],
+                                     self.starts[begin:end],
+                                     self.ends[begin:end]):
+            days, intervals, starts, ends = index[ordinal_weekday(day)]
+            days.append(day)
+            intervals.append(intervals[-1] + stop - start)
+            starts.append(starts[-1] + start)
+            ends.append(ends[-1] + stop)
+
+        self.date_indexes[user_id] = index
+        return index
+
+    def weekday_totals(self, user_id, since=None, until=None):
+        """
+        Returns list of (count, intervals, starts, ends) sums of presence of
+        given user for every weekday.
+
+        Sums are limited to days between given ordinals, inclusive, using
+        binary search over the user's date index.
+        """
+        if since is None and until is None:
+            return self.weekdays.get(user_id, EMPTY_WEEKDAYS)
+
+        result = []
+        for days, intervals, starts, ends in self.date_index(user_id):
+            low = 0 if since is None else bisect_left(days, since)
+            high = len(days) if until is None else bisect_right(days, until)
+            high = max(low, high)
+            result.append((
+                high - low,
+                intervals[high] - intervals[low],
+                starts[high] - starts[low],
+                ends[high] - ends[low],
+            ))
+
+        return result
+
+    def month_location_totals(self, user_id=None):
+        """
+        Sums presence time of all entries, or entries of given user, by month
+        and location.
+
+        Returns: (dict) - with totals like get_year_month_location, except
+        that only the last entry of a user for a day is counted.
+        """
+        if user_id is None:
+            begin, end = 0, len(self)
+        else:
+            begin, end = self.index.get(user_id, (0, 0))
+
+        if vectorized.is_available():
+            return vectorized.month_location_totals(
+                self.days, self.starts, self.ends, self.locations,
+                self.location_names, begin, end
+            )
+
+        result = {}
+        for day, start, stop, code in izip(self.days[begin:end],
+                                           self.starts[begin:end],
+                                           self.ends[begin:end],
+                                           self.locations[begin:end]):
+            date = datetime_date.fromordinal(day)
+            locations = result.setdefault(
+                '{:04d}-{:02d}'.format(date.year, date.month),
+                {}
+            )
+            name = self.location_names[code]
+            locations[name] = locations.get(name, 0) + stop - start
+
+        return result
+
+    def location_index(self, user_id=None):
+        """
+        Returns LocationIndex of presence time of all entries, or entries of
+        given user, built on first use.
+        """
+        index = self.location_indexes.get(user_id)
+        if index is None:
+            index = LocationIndex(self.month_location_totals(user_id))
+            self.location_indexes[user_id] = index
+        return index
+
+    def user_dict(self, user_id):
+        """
+        Returns presence of given user in the dict-of-dicts shape:
+        {
+            datetime.date(2013, 10, 1): {
+                'start': datetime.time(9, 0, 0),
+                'end': datetime.time(17, 30, 0),
+            },
+        }
+        """
+        return {
+            datetime_date.fromordinal(day): {
+                'start': seconds_to_time(start),
+                'end': seconds_to_time(end),
+            }
+            for day, start, end, _ in self.entries(user_id)
+        }
+
+    def as_dict(self):
+        """
+        Returns presence of all users in the dict-of-dicts shape.
+        """
+        return {user_id: self.user_dict(user_id) for user_id in self.index}
@@ -4,16 +4,38 @@ Presence analyzer unit tests.
 """
 from __future__ import unicode_literals
 
+import BaseHTTPServer
 import datetime
+import gzip
+import io
 import json
+import mimetypes
 import os.path
+import shutil
+import socket
+import tempfile
+import threading
 import unittest
+from array import array
 
 import mock
 from lxml import etree
 
 # pylint: disable=unused-import
-from presence_analyzer import main, views, utils
+from presence_analyzer import (
+    directory,
+    download,
+    helpers,
+    loader,
+    main,
+    responses,
+    scheduler,
+    snapshot,
+    store,
+    utils,
+    vectorized,
+    views,
+)
 
 
 TEST_DATA_CSV = os.path.join(
@@ -35,7 +57,10 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         """
         Before each test, set up a environment.
         """
-        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        main.app.config.update({
+            'DATA_CSV': TEST_DATA_CSV,
+            'DATA_XML': TEST_DATA_XML,
+        })
         self.client = main.app.test_client()
 
     def tearDown(self):
@@ -78,6 +103,30 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
             }
         )
 
+    def test_api_users_search(self):
+        """
+        Test searching and paging users listing.
+        """
+        def names(url):
+            """
+            Returns names of users returned from given URL.
+            """
+            return [user['name'] for user in json.loads(
+                self.client.get(url).data
+            )]
+
+        self.assertListEqual(names('/api/v1/users?q=maciej+z'), ['Maciej Z.'])
+        self.assertListEqual(names('/api/v1/users?q=x'), [])
+        self.assertListEqual(names('/api/v1/users?limit=1'), ['Maciej D.'])
+        self.assertListEqual(
+            names('/api/v1/users?offset=1&limit=5'),
+            ['Maciej Z.']
+        )
+        self.assertListEqual(names('/api/v1/users?q=mac&offset=3'), [])
+        for query in ('limit=x', 'offset=-1'):
+            resp = self.client.get('/api/v1/users?' + query)
+            self.assertEqual(resp.status_code, 400)
+
     def test_mean_time_weekday_view(self):
         """
         Test mean time weekday view.
@@ -127,6 +176,29 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         self.assertEqual(resp.status_code, 200)
         self.assertListEqual(weekdays_presence, data)
 
+    def test_presence_weekday_view_date_range(self):
+        """
+        Test presence weekday view limited to a date range.
+        """
+        resp = self.client.get(
+            '/api/v1/presence_weekday/10?from=2013-09-11&to=2013-09-30'
+        )
+        data = json.loads(resp.data)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertListEqual(
+            data[1:5],
+            [['Mon', 0], ['Tue', 0], ['Wed', 24465], ['Thu', 23705]]
+        )
+
+        data = json.loads(self.client.get(
+            '/api/v1/mean_time_weekday/10?to=2013-09-10'
+        ).data)
+        self.assertListEqual(data[1:3], [['Tue', 30047.0], ['Wed', 0]])
+
+        resp = self.client.get('/api/v1/presence_start_end/10?from=2013-9-1')
+        self.assertEqual(resp.status_code, 400)
+
     def test_presence_weekday_view_user_do_not_exist(self):
         """
         Test getting weekly presence for user's id that don't exist.
@@ -155,6 +227,47 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         self.assertEqual(resp.status_code, 200)
         self.assertListEqual(weekdays_means, data)
 
+    def test_batch_view(self):
+        """
+        Test getting statistics of many users in one request.
+        """
+        resp = self.client.get(
+            '/api/v1/batch?users=11,0,10'
+            '&metrics=presence_weekday,presence_start_end'
+        )
+        data = json.loads(resp.data)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertItemsEqual(data.keys(), ['10', '11'])
+        self.assertItemsEqual(
+            data['11'].keys(),
+            ['presence_weekday', 'presence_start_end']
+        )
+        for user_id in ('10', '11'):
+            for name in ('presence_weekday', 'presence_start_end'):
+                self.assertListEqual(
+                    data[user_id][name],
+                    json.loads(self.client.get(
+                        '/api/v1/{}/{}'.format(name, user_id)
+                    ).data)
+                )
+
+        data = json.loads(self.client.get('/api/v1/batch?users=all').data)
+        self.assertItemsEqual(data.keys(), ['10', '11'])
+        self.assertItemsEqual(
+            data['10'].keys(),
+            ['mean_time_weekday', 'presence_weekday', 'presence_start_end']
+        )
+
+    def test_batch_view_bad_request(self):
+        """
+        Test getting statistics for invalid users or metrics.
+        """
+        for url in ('/api/v1/batch',
+                    '/api/v1/batch?users=10,x',
+                    '/api/v1/batch?users=10&metrics=presence_weekday,x'):
+            self.assertEqual(self.client.get(url).status_code, 400)
+
     def test_users_info_view(self):
         """
         Test getting information about user.
@@ -215,6 +328,70 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         self.assertEqual(resp.status_code, 200)
         self.assertDictEqual(data, location_info)
 
+    def test_location_report_view(self):
+        """
+        Test getting presence by location for a range of months.
+        """
+        resp = self.client.get('/api/v1/location_report?year=2013&users=10,0')
+        data = json.loads(resp.data)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertDictEqual(
+            data,
+            {
+                'from': '2013-01',
+                'to': '2013-12',
+                'locations': {'Pila': 76015, 'Poznan': 66350, 'Lodz': 54254},
+                'users': {
+                    '10': {'Pila': 30047, 'Poznan': 24465, 'Lodz': 23705},
+                },
+            }
+        )
+
+        data = json.loads(
+            self.client.get('/api/v1/location_report?from=2013-10').data
+        )
+        self.assertDictEqual(
+            data,
+            {'from': '2013-10', 'to': None, 'locations': {}}
+        )
+
+        for query in ('from=2013-13', 'year=13', 'users=x'):
+            resp = self.client.get('/api/v1/location_report?' + query)
+            self.assertEqual(resp.status_code, 400)
+
+    def test_location_report_duplicated_rows(self):
+        """
+        Test location report summing every row like the monthly view.
+        """
+        temp_dir = tempfile.mkdtemp()
+        path = os.path.join(temp_dir, 'data.csv')
+        with open(TEST_DATA_CSV) as csvfile:
+            lines = csvfile.readlines()
+        with open(path, 'w') as csvfile:
+            csvfile.writelines(lines + lines[1:3])
+        main.app.config['DATA_CSV'] = path
+        utils.get_aggregates.cache.clear()
+
+        try:
+            month = json.loads(
+                self.client.get('/api/v1/presence_location_view/2013-09').data
+            )
+            report = json.loads(self.client.get(
+                '/api/v1/location_report?from=2013-09&to=2013-09&users=all'
+            ).data)
+
+            self.assertDictEqual(report['locations'], month['locations'])
+            self.assertLess(
+                sum(report['users']['10'].values()) +
+                sum(report['users']['11'].values()),
+                sum(month['locations'].values())
+            )
+        finally:
+            main.app.config['DATA_CSV'] = TEST_DATA_CSV
+            utils.get_aggregates.cache.clear()
+            shutil.rmtree(temp_dir)
+
     def test_location_view_date_do_not_exist(self):
         """
         Test getting info for date's id that don't exist.
@@ -223,6 +400,310 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
 
         self.assertEqual(resp.status_code, 404)
 
+    def test_cache_stats_view(self):
+        """
+        Test getting refresh metrics of cached datasets.
+        """
+        resp = self.client.get('/api/v1/cache_stats')
+        data = json.loads(resp.data)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertItemsEqual(
+            data.keys(),
+            ['get_aggregates', 'get_users_avatar_name', 'responses']
+        )
+        self.assertItemsEqual(
+            data['responses'].keys(),
+            ['hits', 'misses', 'size', 'bytes']
+        )
+        self.assertItemsEqual(
+            data['get_aggregates'].keys(),
+            [
+                'last_update', 'refreshes', 'refresh_duration',
+                'stale_hits', 'refreshing', 'hits', 'misses', 'evictions',
+                'size',
+            ]
+        )
+
+    def test_scheduler_view(self):
+        """
+        Test getting state of background refresh.
+        """
+        resp = self.client.get('/api/v1/scheduler')
+        data = json.loads(resp.data)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertItemsEqual(
+            data.keys(),
+            ['mode', 'runs', 'failures', 'last_run', 'next_run', 'datasets']
+        )
+
+    def test_ready_view(self):
+        """
+        Test readiness reported after warm-up.
+        """
+        utils.warm_up()
+
+        resp = self.client.get('/api/v1/ready')
+        data = json.loads(resp.data)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(data['state'], 'ready')
+        self.assertIsNotNone(data['duration'])
+
+    @mock.patch.dict(utils.warm_up_status, {'state': 'running'})
+    def test_ready_view_not_ready(self):
+        """
+        Test readiness reported during warm-up.
+        """
+        resp = self.client.get('/api/v1/ready')
+
+        self.assertEqual(resp.status_code, 503)
+
+
+    def test_conditional_get(self):
+        """
+        Test answering conditional requests without calling the view.
+        """
+        resp = self.client.get('/api/v1/mean_time_weekday/11')
+        etag = resp.headers['ETag']
+        last_modified = resp.headers['Last-Modified']
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Cache-Control'], 'no-cache')
+        self.assertNotEqual(
+            self.client.get('/api/v1/mean_time_weekday/10').headers['ETag'],
+            etag
+        )
+
+        with mock.patch.object(views, 'get_presence_store') as store_mock:
+            resp = self.client.get(
+                '/api/v1/mean_time_weekday/11',
+                headers={'If-None-Match': etag}
+            )
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.headers['ETag'], etag)
+            self.assertEqual(resp.data, b'')
+
+            resp = self.client.get(
+                '/api/v1/mean_time_weekday/11',
+                headers={'If-Modified-Since': last_modified}
+            )
+            self.assertEqual(resp.status_code, 304)
+            self.assertFalse(store_mock.called)
+
+        resp = self.client.get(
+            '/api/v1/mean_time_weekday/11',
+            headers={'If-None-Match': '"other"'}
+        )
+        self.assertEqual(resp.status_code, 200)
+
+    def test_response_cache(self):
+        """
+        Test serving cached response bodies.
+        """
+        responses.response_cache.clear()
+        expected = self.client.get('/api/v1/presence_start_end/10').data
+
+        with mock.patch.object(views, 'get_presence_store') as store_mock:
+            resp = self.client.get('/api/v1/presence_start_end/10')
+            self.assertFalse(store_mock.called)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        self.assertEqual(resp.data, expected)
+        self.assertEqual(self.client.get('/api/v1/users/0').status_code, 404)
+        self.assertEqual(responses.response_cache.stats()['size'], 1)
+
+    @mock.patch.object(responses, 'COMPRESS_MIN_SIZE', 0)
+    def test_compressed_response(self):
+        """
+        Test gzip encoding of JSON responses negotiated with client.
+        """
+        plain = self.client.get('/api/v1/presence_weekday/10')
+        resp = self.client.get(
+            '/api/v1/presence_weekday/10',
+            headers={'Accept-Encoding': 'gzip, deflate'}
+        )
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(resp.headers['Vary'], 'Accept-Encoding')
+        self.assertNotEqual(resp.headers['ETag'], plain.headers['ETag'])
+        self.assertEqual(
+            gzip.GzipFile(fileobj=io.BytesIO(resp.data)).read(),
+            plain.data
+        )
+        self.assertNotIn('Content-Encoding', plain.headers)
+
+        resp = self.client.get(
+            '/api/v1/presence_weekday/10',
+            headers={'Accept-Encoding': 'gzip;q=0'}
+        )
+        self.assertNotIn('Content-Encoding', resp.headers)
+
+        resp = self.client.get(
+            '/api/v1/cache_stats',
+            headers={'Accept-Encoding': 'gzip'}
+        )
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+
+    def test_static_view(self):
+        """
+        Test serving precompressed static files with long-lived cache.
+        """
+        temp_dir = tempfile.mkdtemp()
+        static_folder = main.app.static_folder
+        main.app.static_folder = temp_dir
+        os.mkdir(os.path.join(temp_dir, 'js'))
+        with open(os.path.join(temp_dir, 'js', 'app.js'), 'w') as static:
+            static.write('var presence = {};\n' * 100)
+        helpers.precompress_static()
+
+        try:
+            with main.app.test_request_context():
+                url = helpers.static_url('js/app.js')
+            resp = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(resp.mimetype, mimetypes.guess_type('app.js')[0])
+            self.assertIn('max-age=31536000', resp.headers['Cache-Control'])
+            self.assertEqual(
+                gzip.GzipFile(fileobj=io.BytesIO(resp.data)).read(),
+                'var presence = {};\n' * 100
+            )
+            resp.close()
+
+            resp = self.client.get('/static/js/app.js')
+            self.assertNotIn('Content-Encoding', resp.headers)
+            self.assertNotIn('max-age=31536000', resp.headers['Cache-Control'])
+            resp.close()
+
+            resp = self.client.get('/static/js/missing.js')
+            self.assertEqual(resp.status_code, 404)
+        finally:
+            main.app.static_folder = static_folder
+            helpers._static_hashes.clear()  # pylint: disable=protected-access
+            shutil.rmtree(temp_dir)
+
+    def test_conditional_get_with_snapshot(self):
+        """
+        Test keeping ETag while the process writes its own snapshot.
+        """
+        temp_dir = tempfile.mkdtemp()
+        main.app.config.update({
+            'DATA_CSV': os.path.join(temp_dir, 'data.csv'),
+            'DATA_SNAPSHOT': os.path.join(temp_dir, 'data.snapshot'),
+        })
+        shutil.copy(TEST_DATA_CSV, main.app.config['DATA_CSV'])
+        utils.get_aggregates.cache.clear()
+        refreshes = utils.get_aggregates.cache.stats()['refreshes']
+
+        try:
+            etags = [
+                self.client.get('/api/v1/presence_weekday/10').headers['ETag']
+                for _ in range(2)
+            ]
+            self.assertEqual(etags[0], etags[1])
+            self.assertTrue(os.path.exists(main.app.config['DATA_SNAPSHOT']))
+            self.assertEqual(
+                utils.get_aggregates.cache.stats()['refreshes'],
+                refreshes + 1
+            )
+
+            main.app.config['DATA_PLANE'] = 'shared'
+            self.assertTupleEqual(
+                utils.get_aggregates_sources(),
+                ('DATA_CSV', 'DATA_SNAPSHOT')
+            )
+        finally:
+            main.app.config['DATA_CSV'] = TEST_DATA_CSV
+            del main.app.config['DATA_SNAPSHOT']
+            main.app.config.pop('DATA_PLANE', None)
+            utils.get_aggregates.cache.clear()
+            shutil.rmtree(temp_dir)
+
+    def test_conditional_get_changed_data(self):
+        """
+        Test full response to conditional request after data changed.
+        """
+        temp_dir = tempfile.mkdtemp()
+        path = os.path.join(temp_dir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, path)
+        main.app.config['DATA_CSV'] = path
+
+        try:
+            etag = self.client.get('/api/v1/presence_weekday/11').headers[
+                'ETag'
+            ]
+            with open(path, 'a') as csvfile:
+                csvfile.write('11,2013-09-16,09:00:00,17:00:00,Lodz\n')
+            utils.get_aggregates.cache.clear()
+
+            resp = self.client.get(
+                '/api/v1/presence_weekday/11',
+                headers={'If-None-Match': etag}
+            )
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.headers['ETag'], etag)
+        finally:
+            main.app.config['DATA_CSV'] = TEST_DATA_CSV
+            utils.get_aggregates.cache.clear()
+            shutil.rmtree(temp_dir)
+
+
+class PresenceAnalyzerHelpersTestCase(unittest.TestCase):
+    """
+    Template helpers tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.directory = tempfile.mkdtemp()
+        self.static_folder = main.app.static_folder
+        main.app.static_folder = self.directory
+        os.mkdir(os.path.join(self.directory, 'css'))
+        with open(os.path.join(self.directory, 'css', 'style.css'), 'w') as f:
+            f.write('body { margin: 0; }\n')
+        with open(os.path.join(self.directory, 'loading.gif'), 'w') as f:
+            f.write('GIF89a')
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        main.app.static_folder = self.static_folder
+        helpers._static_hashes.clear()  # pylint: disable=protected-access
+        shutil.rmtree(self.directory)
+
+    def test_static_url(self):
+        """
+        Test building content-hashed URLs of static files.
+        """
+        with main.app.test_request_context():
+            self.assertEqual(
+                helpers.static_url('/css/style.css'),
+                '/static/css/style.css?v=cfdf05fd8a77'
+            )
+
+    def test_precompress_static(self):
+        """
+        Test writing gzipped copies of compressible static files.
+        """
+        path = os.path.join(self.directory, 'css', 'style.css.gz')
+
+        self.assertListEqual(helpers.precompress_static(), [path])
+        self.assertListEqual(helpers.precompress_static(), [])
+        self.assertEqual(
+            gzip.open(path).read(),
+            'body { margin: 0; }\n'
+        )
+        self.assertFalse(
+            os.path.exists(os.path.join(self.directory, 'loading.gif.gz'))
+        )
+
 
 class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
     """
@@ -264,6 +745,69 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
             datetime.time(9, 39, 5)
         )
 
+    def test_get_aggregates(self):
+        """
+        Test building all registered aggregates in a single pass.
+        """
+        data = utils.get_aggregates()
+
+        self.assertItemsEqual(
+            data.keys(),
+            [item.name for item in loader.AGGREGATES]
+        )
+        self.assertIs(data['presence'], utils.get_presence_store())
+        self.assertIs(
+            data['year_month_location'],
+            utils.get_year_month_location()
+        )
+
+    def test_parse_date(self):
+        """
+        Test parsing of dates in the presence export format.
+        """
+        self.assertEqual(
+            loader.parse_date('2013-09-10'),
+            datetime.date(2013, 9, 10)
+        )
+        self.assertIs(
+            loader.parse_date('2013-09-10'),
+            loader.parse_date('2013-09-10')
+        )
+        with self.assertRaises(ValueError):
+            loader.parse_date('2013-9-10')
+        with self.assertRaises(ValueError):
+            loader.parse_date('2013-02-30')
+
+    def test_parse_time(self):
+        """
+        Test parsing of times in the presence export format.
+        """
+        self.assertEqual(
+            loader.parse_time('09:39:05'),
+            datetime.time(9, 39, 5)
+        )
+        with self.assertRaises(ValueError):
+            loader.parse_time('9:39:05')
+        with self.assertRaises(ValueError):
+            loader.parse_time('24:00:00')
+
+    def test_parse_seconds(self):
+        """
+        Test parsing of times into seconds since midnight.
+        """
+        self.assertEqual(loader.parse_seconds('01:07:05'), 4025)
+        with self.assertRaises(ValueError):
+            loader.parse_seconds('01:07')
+        with self.assertRaises(ValueError):
+            loader.parse_seconds('01:60:00')
+
+    def test_average(self):
+        """
+        Test average method.
+        """
+        self.assertEqual(utils.average(45, 9), 5.0)
+        self.assertEqual(utils.average(0, 0), 0)
+
     def test_seconds_since_midnight(self):
         """
         Test seconds_since_midnight method.
@@ -322,6 +866,25 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
 
         self.assertDictEqual(grouped_by_weekday, result)
 
+    def test_weekday_metrics(self):
+        """
+        Test computing weekday statistics from per-weekday totals.
+        """
+        weekdays = [(2, 54000, 64800, 118800)] + [(0, 0, 0, 0)] * 6
+
+        self.assertListEqual(
+            utils.mean_time_weekday(weekdays)[:2],
+            [('Mon', 27000.0), ('Tue', 0)]
+        )
+        self.assertListEqual(
+            utils.presence_weekday(weekdays)[:3],
+            [('Weekday', 'Presence (s)'), ('Mon', 54000), ('Tue', 0)]
+        )
+        self.assertListEqual(
+            utils.presence_start_end(weekdays)[:2],
+            [['Mon', 32400.0, 59400.0], ['Tue', 0, 0]]
+        )
+
     def test_group_by_weekday_start_end(self):
         """
         Test group_by_weekday_start_end method.
@@ -445,7 +1008,14 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
             }
         }
 
-        self.assertDictEqual(utils.get_full_users_data(), test_data)
+        users = utils.get_full_users_data()
+
+        self.assertDictEqual(users.as_dict(), test_data)
+        self.assertEqual(users[11]['name'], 'Maciej D.')
+        self.assertDictEqual(users[10].presence, test_data[10]['presence'])
+        self.assertNotIn(12, users)
+        self.assertRaises(KeyError, users.__getitem__, 12)
+        self.assertNotIn('presence', utils.get_users_avatar_name()[10])
 
     @mock.patch('presence_analyzer.utils.datetime')
     def test_cache_decorator(self, datetime_mock):
@@ -453,7 +1023,6 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         Test checks the Cache decorator.
         """
         cache = utils.Cache(600)
-        cache.cached_data = None
 
         @cache
         def fun(some_data):
@@ -474,21 +1043,1644 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         data_3 = fun(30)
         self.assertNotEqual(data_3, data_2)
 
-    def test_get_year_month_location(self):
+    def test_cache_decorator_sources(self):
         """
-        Test parsing of CSV file.
+        Test checks the Cache decorator invalidated by source file changes.
         """
-        sample_date = {
-            '2013-09': {
-                'Pila': 76015,
-                'Poznan': 66350,
-                'Lodz': 54254
-            }
-        }
+        temp_dir = tempfile.mkdtemp()
+        path = os.path.join(temp_dir, 'data.csv')
+        main.app.config['TEST_SOURCE'] = path
+        cache = utils.Cache(sources=('TEST_SOURCE',))
+        calls = []
 
-        data = utils.get_year_month_location()
+        @cache
+        def fun():
+            """
+            Function to test the cache
+            """
+            calls.append(None)
+            return len(calls)
+
+        try:
+            self.assertEqual(fun(), 1)
+            self.assertEqual(fun(), 1)
+
+            with open(path, 'w') as source:
+                source.write('data')
+            self.assertEqual(fun(), 2)
+            self.assertEqual(fun(), 2)
+
+            with open(path, 'a') as source:
+                source.write('more data')
+            self.assertEqual(fun(), 3)
+        finally:
+            shutil.rmtree(temp_dir)
+            del main.app.config['TEST_SOURCE']
+
+    def test_response_cache(self):
+        """
+        Test least recently used cache of response bodies.
+        """
+        cache = responses.ResponseCache(2, 1024)
 
-        self.assertDictEqual(data, sample_date)
+        self.assertIsNone(cache.get('a'))
+        cache.set('a', '[1]', None, 'application/json')
+        cache.set('b', '[22]', None, 'application/json')
+        self.assertEqual(cache.get('a'), ('[1]', None, 'application/json'))
+        cache.set('c', '[333]', 'gzip', 'application/json')
+
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(
+            cache.get('c'),
+            ('[333]', 'gzip', 'application/json')
+        )
+        self.assertDictEqual(
+            cache.stats(),
+            {'hits': 2, 'misses': 2, 'size': 2, 'bytes': 8}
+        )
+
+    def test_response_cache_bytes(self):
+        """
+        Test limiting total size of cached response bodies.
+        """
+        cache = responses.ResponseCache(10, 80)
+
+        cache.set('a', 'a' * 10, None, 'application/json')
+        cache.set('b', 'b' * 10, None, 'application/json')
+        cache.set('a', 'a' * 5, None, 'application/json')
+        cache.set('large', 'c' * 11, None, 'application/json')
+        self.assertIsNone(cache.get('large'))
+        self.assertEqual(cache.stats()['bytes'], 15)
+
+        for key in 'cdefghi':
+            cache.set(key, key * 10, None, 'application/json')
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertEqual(cache.stats()['bytes'], 75)
+        self.assertEqual(cache.stats()['size'], 8)
+
+    def test_cache_refresh(self):
+        """
+        Test rebuilding cached data outside of calls.
+        """
+        temp_dir = tempfile.mkdtemp()
+        path = os.path.join(temp_dir, 'data.csv')
+        main.app.config['TEST_SOURCE'] = path
+        calls = []
+
+        @utils.Cache(sources=('TEST_SOURCE',))
+        def fun():
+            """
+            Function to test the cache
+            """
+            calls.append(None)
+            return len(calls)
+
+        try:
+            self.assertTrue(fun.refresh())
+            self.assertFalse(fun.refresh())
+            self.assertEqual(fun(), 1)
+            self.assertTrue(fun.refresh(force=True))
+            self.assertEqual(fun(), 2)
+
+            fun.cache.scheduled = True
+            with open(path, 'w') as source:
+                source.write('data')
+            self.assertEqual(fun(), 2)
+            self.assertTrue(fun.refresh())
+            self.assertEqual(fun(), 3)
+        finally:
+            shutil.rmtree(temp_dir)
+            del main.app.config['TEST_SOURCE']
+
+    def test_cache_refresh_concurrently(self):
+        """
+        Test refreshing cached data while it is built by a call.
+        """
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        running = []
+
+        @utils.Cache(600)
+        def fun():
+            """
+            Function to test the cache
+            """
+            running.append(None)
+            calls.append(len(running))
+            started.set()
+            release.wait()
+            running.pop()
+            return len(calls)
+
+        call = threading.Thread(target=fun)
+        call.start()
+        self.assertTrue(started.wait(5))
+        results = []
+        refreshes = [
+            threading.Thread(
+                target=lambda force=force: results.append(
+                    fun.refresh(force=force)
+                )
+            )
+            for force in (False, True)
+        ]
+        for thread in refreshes:
+            thread.start()
+        release.set()
+        for thread in [call] + refreshes:
+            thread.join()
+
+        self.assertItemsEqual(results, [False, True])
+        self.assertListEqual(calls, [1, 1])
+        self.assertEqual(fun(), 2)
+
+    @mock.patch('presence_analyzer.utils.datetime')
+    def test_cache_version(self, datetime_mock):
+        """
+        Test getting version of cached data.
+        """
+        datetime_mock.now.return_value = datetime.datetime(2017, 6, 1, 12)
+        main.app.config['TEST_SOURCE'] = TEST_DATA_CSV
+        sources = utils.Cache(sources=('TEST_SOURCE',))(lambda: None)
+        timed = utils.Cache(60)(lambda: None)
+
+        try:
+            self.assertIsNone(sources.cache.version())
+            sources()
+            timed()
+            self.assertEqual(
+                sources.cache.version(),
+                utils.get_sources_signature(('TEST_SOURCE',))
+            )
+            self.assertEqual(timed.cache.version(), '2017-06-01T12:00:00')
+        finally:
+            del main.app.config['TEST_SOURCE']
+
+    def test_cache_decorator_stale_while_revalidate(self):
+        """
+        Test checks the Cache decorator serving stale data while refreshing.
+        """
+        temp_dir = tempfile.mkdtemp()
+        path = os.path.join(temp_dir, 'data.csv')
+        main.app.config['TEST_SOURCE'] = path
+        cache = utils.Cache(
+            sources=('TEST_SOURCE',),
+            stale_while_revalidate=True
+        )
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        @cache
+        def fun():
+            """
+            Function to test the cache
+            """
+            calls.append(None)
+            if len(calls) > 1:
+                started.set()
+                release.wait()
+            return len(calls)
+
+        try:
+            self.assertEqual(fun(), 1)
+
+            with open(path, 'w') as source:
+                source.write('data')
+            self.assertEqual(fun(), 1)
+            self.assertTrue(started.wait(5))
+            self.assertEqual(fun(), 1)
+            self.assertEqual(len(calls), 2)
+            self.assertTrue(cache.stats()['refreshing'])
+
+            threads = cache.refresh_threads.values()
+            release.set()
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual(fun(), 2)
+            stats = cache.stats()
+            self.assertEqual(stats['refreshes'], 2)
+            self.assertEqual(stats['stale_hits'], 2)
+            self.assertFalse(stats['refreshing'])
+            self.assertIsNotNone(stats['refresh_duration'])
+        finally:
+            shutil.rmtree(temp_dir)
+            del main.app.config['TEST_SOURCE']
+
+    def test_cache_decorator_concurrent_builds(self):
+        """
+        Test checks the Cache decorator building data outside of the lock,
+        once per arguments.
+        """
+        cache = utils.Cache(600, maxsize=2)
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        @cache
+        def fun(some_data):
+            """
+            Function to test the cache
+            """
+            calls.append(some_data)
+            if some_data == 2:
+                started.set()
+                release.wait()
+            return some_data
+
+        self.assertEqual(fun(1), 1)
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(fun(2)))
+            for _ in range(3)
+        ]
+        for thread in threads:
+            thread.start()
+        self.assertTrue(started.wait(5))
+
+        self.assertEqual(fun(1), 1)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertListEqual(results, [2, 2, 2])
+        self.assertListEqual(calls, [1, 2])
+        self.assertEqual(cache.stats()['misses'], 2)
+
+    def test_cache_decorator_maxsize_without_time_limit(self):
+        """
+        Test checks the Cache decorator memoizing results without expiry.
+        """
+        calls = []
+
+        @utils.Cache(maxsize=10)
+        def fun(some_data):
+            """
+            Function to test the cache
+            """
+            calls.append(some_data)
+            return some_data
+
+        for _ in range(3):
+            self.assertEqual(fun(1), 1)
+        self.assertEqual(fun(2), 2)
+        self.assertListEqual(calls, [1, 2])
+
+    @mock.patch('presence_analyzer.utils.datetime')
+    def test_cache_decorator_maxsize(self, datetime_mock):
+        """
+        Test checks the Cache decorator memoizing results per arguments.
+        """
+        cache = utils.Cache(600, maxsize=2)
+        calls = []
+
+        @cache
+        def fun(some_data, factor=1):
+            """
+            Function to test the cache
+            """
+            calls.append(some_data)
+            return some_data * factor
+
+        datetime_mock.now.return_value = datetime.datetime(2010, 1, 1, 13, 10)
+        self.assertEqual(fun(1), 1)
+        self.assertEqual(fun(2), 2)
+        self.assertEqual(fun(1), 1)
+        self.assertEqual(fun(2, factor=3), 6)
+        self.assertListEqual(calls, [1, 2, 2])
+
+        self.assertEqual(fun(1), 1)
+        self.assertEqual(fun(2), 2)
+        self.assertListEqual(calls, [1, 2, 2, 2])
+
+        datetime_mock.now.return_value = datetime.datetime(2010, 1, 1, 13, 25)
+        self.assertEqual(fun(1), 1)
+        self.assertListEqual(calls, [1, 2, 2, 2, 1])
+
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 5)
+        self.assertEqual(stats['evictions'], 2)
+        self.assertEqual(stats['size'], 2)
+
+    def test_get_sources_signature(self):
+        """
+        Test getting signature of source files.
+        """
+        signature = utils.get_sources_signature(['DATA_CSV'])
+        stat = os.stat(TEST_DATA_CSV)
+
+        self.assertEqual(
+            signature,
+            ((TEST_DATA_CSV, stat.st_ino, stat.st_size, stat.st_mtime),)
+        )
+
+        main.app.config['DATA_CSV'] = TEST_DATA_CSV + '.missing'
+        try:
+            self.assertEqual(
+                utils.get_sources_signature(['DATA_CSV']),
+                ((TEST_DATA_CSV + '.missing', None),)
+            )
+        finally:
+            main.app.config['DATA_CSV'] = TEST_DATA_CSV
+
+    def test_warm_up(self):
+        """
+        Test loading all cached datasets.
+        """
+        with mock.patch.object(utils, 'DATASETS', [mock.Mock()]):
+            utils.warm_up()
+            utils.DATASETS[0].assert_called_once_with()
+
+        self.assertEqual(utils.warm_up_status['state'], 'ready')
+
+        failing = mock.Mock(side_effect=IOError)
+        with mock.patch.object(utils, 'DATASETS', [failing]):
+            utils.warm_up()
+
+        self.assertEqual(utils.warm_up_status['state'], 'failed')
+
+    def test_start_warm_up(self):
+        """
+        Test starting warm-up in different modes.
+        """
+        with mock.patch.object(utils, 'warm_up') as warm_up:
+            utils.start_warm_up(None)
+            self.assertFalse(warm_up.called)
+
+            utils.start_warm_up('sync')
+            warm_up.assert_called_once_with()
+
+        with self.assertRaises(ValueError):
+            utils.start_warm_up('eager')
+
+    def test_parse_rows(self):
+        """
+        Test parsing CSV lines, skipping malformed ones.
+        """
+        rows = loader.parse_rows([
+            'user_id,date,start,end,location\n',
+            '10,2013-09-10,09:39:05,17:59:52,Pila\n',
+            '10,2013-09-xx,09:39:05,17:59:52,Pila\n',
+        ])
+
+        self.assertListEqual(
+            list(rows),
+            [(10, datetime.date(2013, 9, 10), 34745, 64792, 'Pila')]
+        )
+
+    def test_filter_rows(self):
+        """
+        Test filtering parsed rows by date range and users.
+        """
+        rows = [
+            (10, datetime.date(2013, 9, day), 0, 1, 'Pila')
+            for day in (1, 2, 3)
+        ] + [(11, datetime.date(2013, 9, 2), 0, 1, 'Pila')]
+
+        self.assertListEqual(
+            list(loader.filter_rows(
+                rows,
+                since=datetime.date(2013, 9, 2),
+                until=datetime.date(2013, 9, 2)
+            )),
+            [rows[1], rows[3]]
+        )
+        self.assertListEqual(
+            list(loader.filter_rows(rows, user_ids={11})),
+            [rows[3]]
+        )
+        self.assertListEqual(list(loader.filter_rows(rows)), rows)
+
+    def test_stream_csv(self):
+        """
+        Test streaming CSV file through sinks.
+        """
+        presence, locations = loader.stream_csv(
+            TEST_DATA_CSV,
+            [
+                loader.PresenceAggregate(),
+                loader.YearMonthLocationAggregate(),
+            ],
+            since=datetime.date(2013, 9, 12),
+            user_ids={10},
+        )
+
+        self.assertListEqual(presence.users(), [10])
+        self.assertEqual(len(presence), 1)
+        self.assertDictEqual(locations, {'2013-09': {'Lodz': 23705}})
+
+    def test_get_year_month_location(self):
+        """
+        Test parsing of CSV file.
+        """
+        sample_date = {
+            '2013-09': {
+                'Pila': 76015,
+                'Poznan': 66350,
+                'Lodz': 54254
+            }
+        }
+
+        data = utils.get_year_month_location()
+
+        self.assertDictEqual(data, sample_date)
+
+
+class PresenceAnalyzerStoreTestCase(unittest.TestCase):
+    """
+    Columnar presence store tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        days = [
+            datetime.date(2013, 10, day).toordinal()
+            for day in (8, 1, 3, 2, 1)
+        ]
+        self.store = store.PresenceStore.from_columns(
+            array('i', [10, 10, 11, 10, 10]),
+            array('i', days),
+            array('i', [32400, 0, 28800, 30600, 32400]),
+            array('i', [61200, 0, 57600, 60300, 63000]),
+            array('H', [1, 0, 1, 0, 0]),
+            ['Pila', 'Lodz']
+        )
+
+    def test_seconds_to_time(self):
+        """
+        Test converting seconds since midnight to time.
+        """
+        self.assertEqual(store.seconds_to_time(4025), datetime.time(1, 7, 5))
+
+    def test_ordinal_weekday(self):
+        """
+        Test getting weekday of an ordinal.
+        """
+        day = datetime.date(2013, 10, 6)
+
+        self.assertEqual(store.ordinal_weekday(day.toordinal()), 6)
+
+    def test_month_number(self):
+        """
+        Test converting months to numbers and back.
+        """
+        self.assertEqual(store.month_number('2013-10'), 24165)
+        self.assertEqual(store.format_month(24165), '2013-10')
+        self.assertEqual(store.format_month(24168), '2014-01')
+        for text in ('2013-1', '2013-13', '2013/10'):
+            self.assertRaises(ValueError, store.month_number, text)
+
+    def test_location_index(self):
+        """
+        Test totals of ranges of months from prefix sums.
+        """
+        index = store.LocationIndex({
+            '2013-11': {'Pila': 10, 'Lodz': 1},
+            '2014-02': {'Pila': 20},
+            '2014-01': {'Lodz': 300},
+        })
+        month = store.month_number
+
+        self.assertDictEqual(index.totals(), {'Pila': 30, 'Lodz': 301})
+        self.assertDictEqual(
+            index.totals(month('2013-12'), month('2014-01')),
+            {'Lodz': 300}
+        )
+        self.assertDictEqual(
+            index.totals(since=month('2014-02')),
+            {'Pila': 20}
+        )
+        self.assertDictEqual(
+            index.totals(until=month('2013-11')),
+            {'Pila': 10, 'Lodz': 1}
+        )
+        self.assertDictEqual(
+            index.totals(month('2010-01'), month('2012-01')),
+            {}
+        )
+        self.assertDictEqual(
+            index.totals(month('2014-02'), month('2014-01')),
+            {}
+        )
+        self.assertDictEqual(store.LocationIndex({}).totals(), {})
+
+    def test_from_columns(self):
+        """
+        Test building sorted parallel arrays with per-user index.
+        """
+        self.assertEqual(len(self.store), 4)
+        self.assertListEqual(self.store.users(), [10, 11])
+        self.assertListEqual(list(self.store.user_ids), [10, 10, 10, 11])
+        self.assertDictEqual(self.store.index, {10: (0, 3), 11: (3, 4)})
+        self.assertListEqual(
+            list(self.store.starts),
+            [32400, 30600, 32400, 28800]
+        )
+        self.assertIn(10, self.store)
+        self.assertNotIn(12, self.store)
+
+    def test_entries(self):
+        """
+        Test iterating over entries of a user.
+        """
+        self.assertListEqual(
+            list(self.store.entries(11)),
+            [(datetime.date(2013, 10, 3).toordinal(), 28800, 57600, 'Lodz')]
+        )
+        self.assertListEqual(list(self.store.entries(12)), [])
+
+    def test_sum_by_weekday(self):
+        """
+        Test summing entries by weekday.
+        """
+        days = array('i', [
+            datetime.date(2013, 10, day).toordinal() for day in (1, 2, 8)
+        ])
+        starts = array('i', [32400, 30600, 32400])
+        ends = array('i', [63000, 60300, 61200])
+
+        result = store.sum_by_weekday(days, starts, ends, 0, 3)
+
+        self.assertEqual(len(result), 7)
+        self.assertEqual(result[0], (0, 0, 0, 0))
+        self.assertEqual(result[1], (2, 59400, 64800, 124200))
+        self.assertEqual(result[2], (1, 29700, 30600, 60300))
+
+    def test_weekday_totals(self):
+        """
+        Test getting precomputed weekday totals of a user.
+        """
+        self.assertEqual(
+            self.store.weekday_totals(10)[1],
+            (2, 59400, 64800, 124200)
+        )
+        self.assertEqual(
+            self.store.weekday_totals(11)[3],
+            (1, 28800, 28800, 57600)
+        )
+        self.assertListEqual(
+            self.store.weekday_totals(12),
+            [(0, 0, 0, 0)] * 7
+        )
+
+    def test_merge(self):
+        """
+        Test merging stores, appended and overlapping entries.
+        """
+        day = datetime.date(2013, 10, 9).toordinal()
+        other = store.PresenceStore.from_columns(
+            array('i', [10, 11, 12]),
+            array('i', [day, day - 8, day]),
+            array('i', [3600, 3600, 3600]),
+            array('i', [7200, 7200, 7200]),
+            array('H', [0, 0, 1]),
+            ['Poznan', 'Lodz']
+        )
+
+        merged = self.store.merge(other)
+
+        self.assertListEqual(merged.users(), [10, 11, 12])
+        self.assertListEqual(merged.location_names, ['Pila', 'Lodz', 'Poznan'])
+        self.assertEqual(
+            list(merged.entries(10))[-1],
+            (day, 3600, 7200, 'Poznan')
+        )
+        self.assertListEqual(
+            [entry[0] for entry in merged.entries(11)],
+            [day - 8, day - 6]
+        )
+        self.assertEqual(list(merged.entries(12)), [(day, 3600, 7200, 'Lodz')])
+        self.assertEqual(
+            merged.weekday_totals(10)[2],
+            (2, 33300, 34200, 67500)
+        )
+        self.assertEqual(merged.weekday_totals(11)[1], (1, 3600, 3600, 7200))
+        self.assertEqual(len(self.store), 4)
+
+    def test_mapped_column(self):
+        """
+        Test reading column from a buffer.
+        """
+        data = b'\0' * 8 + array('i', [5, 6, 7, 8]).tostring()
+        column = store.MappedColumn('i', data, 8, 3)
+
+        self.assertEqual(len(column), 3)
+        self.assertEqual(column[0], 5)
+        self.assertEqual(column[-1], 7)
+        self.assertEqual(column[1:], array('i', [6, 7]))
+        self.assertEqual(column[2:1], array('i'))
+        self.assertListEqual(list(column), [5, 6, 7])
+        self.assertEqual(column.tostring(), array('i', [5, 6, 7]).tostring())
+        with self.assertRaises(IndexError):
+            column[3]  # pylint: disable=pointless-statement
+
+    def test_dumps_loads(self):
+        """
+        Test converting store to binary representation and back.
+        """
+        loaded = store.PresenceStore.loads(self.store.dumps())
+
+        for column, loaded_column in zip(self.store.columns(),
+                                         loaded.columns()):
+            self.assertListEqual(list(column), list(loaded_column))
+        self.assertListEqual(
+            list(loaded.entries(10)),
+            list(self.store.entries(10))
+        )
+        self.assertListEqual(loaded.location_names, ['Pila', 'Lodz'])
+        self.assertDictEqual(loaded.index, self.store.index)
+        self.assertDictEqual(loaded.weekdays, self.store.weekdays)
+
+    def test_location_index_of_user(self):
+        """
+        Test building month index of locations of a user.
+        """
+        index = self.store.location_index(11)
+
+        self.assertDictEqual(index.totals(), {'Lodz': 28800})
+        self.assertIs(self.store.location_index(11), index)
+        self.assertDictEqual(
+            self.store.location_index().totals(),
+            {'Pila': 60300, 'Lodz': 57600}
+        )
+
+    def test_weekday_totals_date_range(self):
+        """
+        Test summing entries by weekday between given days.
+        """
+        def day(number):
+            """
+            Returns ordinal of given day of October 2013.
+            """
+            return datetime.date(2013, 10, number).toordinal()
+
+        totals = self.store.weekday_totals(10, day(2), day(8))
+        self.assertTupleEqual(totals[1], (1, 28800, 32400, 61200))
+        self.assertTupleEqual(totals[2], (1, 29700, 30600, 60300))
+        self.assertTupleEqual(totals[3], (0, 0, 0, 0))
+
+        totals = self.store.weekday_totals(10, since=day(3))
+        self.assertTupleEqual(totals[1], (1, 28800, 32400, 61200))
+        self.assertTupleEqual(totals[2], (0, 0, 0, 0))
+
+        totals = self.store.weekday_totals(10, until=day(7))
+        self.assertTupleEqual(totals[1], (1, 30600, 32400, 63000))
+
+        self.assertListEqual(
+            self.store.weekday_totals(10, day(1), day(31)),
+            self.store.weekday_totals(10)
+        )
+        self.assertListEqual(
+            self.store.weekday_totals(10, day(8), day(1)),
+            [(0, 0, 0, 0)] * 7
+        )
+        self.assertListEqual(
+            self.store.weekday_totals(12, day(1), day(31)),
+            [(0, 0, 0, 0)] * 7
+        )
+        self.assertIs(self.store.date_index(10), self.store.date_index(10))
+
+    def test_month_location_totals(self):
+        """
+        Test summing presence by month and location.
+        """
+        with mock.patch.object(vectorized, 'numpy', None):
+            self.assertDictEqual(
+                self.store.month_location_totals(),
+                {'2013-10': {'Pila': 60300, 'Lodz': 57600}}
+            )
+            self.assertDictEqual(
+                self.store.month_location_totals(11),
+                {'2013-10': {'Lodz': 28800}}
+            )
+            self.assertDictEqual(self.store.month_location_totals(12), {})
+
+    def test_user_dict(self):
+        """
+        Test getting presence of a user in the dict-of-dicts shape.
+        """
+        self.assertDictEqual(
+            self.store.user_dict(11),
+            {
+                datetime.date(2013, 10, 3): {
+                    'start': datetime.time(8, 0, 0),
+                    'end': datetime.time(16, 0, 0),
+                },
+            }
+        )
+        self.assertItemsEqual(self.store.as_dict().keys(), [10, 11])
+
+
+class PresenceAnalyzerCSVLoaderTestCase(unittest.TestCase):
+    """
+    Incremental CSV loader tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, self.path)
+        self.loader = loader.CSVLoader(loader.AGGREGATES)
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.directory)
+
+    def append(self, text):
+        """
+        Appends text to the CSV file.
+        """
+        with open(self.path, 'a') as csvfile:
+            csvfile.write(text)
+
+    def test_load(self):
+        """
+        Test loading the whole file.
+        """
+        data = self.loader.load(self.path)
+
+        self.assertItemsEqual(data['presence'].users(), [10, 11])
+        self.assertEqual(self.loader.position, os.path.getsize(self.path))
+        self.assertIs(self.loader.load(self.path), data)
+
+    def test_load_appended(self):
+        """
+        Test loading only lines appended since previous load.
+        """
+        self.loader.load(self.path)
+        size = os.path.getsize(self.path)
+        self.append('12,2013-10-01,09:00:00,17:00:00,Pila\n12,2013-10')
+
+        data = self.loader.load(self.path)
+
+        self.assertEqual(self.loader.position, size + 37)
+        self.assertItemsEqual(data['presence'].users(), [10, 11, 12])
+        self.assertEqual(
+            data['year_month_location']['2013-10'],
+            {'Pila': 28800}
+        )
+        self.assertEqual(
+            data['year_month_location']['2013-09']['Pila'],
+            76015
+        )
+
+        self.append('-02,09:00:00,10:00:00,Lodz\n')
+        data = self.loader.load(self.path)
+
+        self.assertEqual(
+            data['year_month_location']['2013-10'],
+            {'Pila': 28800, 'Lodz': 3600}
+        )
+        self.assertEqual(data['presence'].weekday_totals(12)[2][0], 1)
+
+    def test_load_concurrently(self):
+        """
+        Test loading the file from many threads at once.
+        """
+        threads = [
+            threading.Thread(target=self.loader.load, args=(self.path,))
+            for _ in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(
+            self.loader.load(self.path)['year_month_location']['2013-09'][
+                'Pila'
+            ],
+            76015
+        )
+
+    def test_load_unterminated(self):
+        """
+        Test serving last line without trailing newline until it is complete.
+        """
+        size = os.path.getsize(self.path)
+        self.append('12,2013-10-01,09:00:00,17:00:00,Pi')
+        data = self.loader.load(self.path)
+
+        self.assertItemsEqual(data['presence'].users(), [10, 11, 12])
+        self.assertEqual(data['year_month_location']['2013-10'], {'Pi': 28800})
+        self.assertEqual(self.loader.position, size)
+        self.assertNotIn('2013-10', self.loader.results['year_month_location'])
+
+        self.append('la\n12,2013-10-02,09:00:00,10:00:00,Lodz')
+        data = self.loader.load(self.path)
+
+        self.assertEqual(
+            data['year_month_location']['2013-10'],
+            {'Pila': 28800, 'Lodz': 3600}
+        )
+        self.assertEqual(data['presence'].weekday_totals(12)[1][0], 1)
+        self.assertEqual(
+            self.loader.load(self.path)['year_month_location']['2013-10'],
+            {'Pila': 28800, 'Lodz': 3600}
+        )
+
+    def test_load_truncated(self):
+        """
+        Test loading truncated file from the beginning.
+        """
+        self.loader.load(self.path)
+        with open(self.path, 'w') as csvfile:
+            csvfile.write('12,2013-10-01,09:00:00,17:00:00,Pila\n')
+
+        data = self.loader.load(self.path)
+
+        self.assertItemsEqual(data['presence'].users(), [12])
+        self.assertItemsEqual(data['year_month_location'].keys(), ['2013-10'])
+
+    def test_load_rewritten(self):
+        """
+        Test loading file rewritten in place from the beginning.
+        """
+        with open(self.path, 'r') as csvfile:
+            lines = csvfile.readlines()
+        self.loader.load(self.path)
+        with open(self.path, 'r+') as csvfile:
+            csvfile.writelines(
+                lines[:2] + ['10,2013-09-13,09:00:00,10:00:00,Lodz\n'] +
+                lines[2:]
+            )
+
+        data = self.loader.load(self.path)
+        expected = loader.CSVLoader(loader.AGGREGATES).load(self.path)
+
+        self.assertDictEqual(
+            data['year_month_location'],
+            expected['year_month_location']
+        )
+        self.assertDictEqual(
+            data['presence'].weekdays,
+            expected['presence'].weekdays
+        )
+
+    def test_load_replaced(self):
+        """
+        Test loading replaced file from the beginning.
+        """
+        self.loader.load(self.path)
+        with open(self.path, 'r') as csvfile:
+            lines = csvfile.readlines()
+        with open(self.path, 'w') as csvfile:
+            csvfile.writelines(lines[::-1] + lines)
+
+        data = self.loader.load(self.path)
+
+        self.assertEqual(
+            data['year_month_location']['2013-09']['Pila'],
+            2 * 76015
+        )
+
+    def test_load_snapshot(self):
+        """
+        Test restoring results from snapshot and reading appended lines.
+        """
+        snapshot_path = os.path.join(self.directory, 'data.snapshot')
+        data = self.loader.load(self.path, snapshot_path)
+
+        csv_loader = loader.CSVLoader(loader.AGGREGATES)
+        with mock.patch.object(loader, 'parse_rows') as parse_rows:
+            restored = csv_loader.load(self.path, snapshot_path)
+
+        self.assertFalse(parse_rows.called)
+        self.assertEqual(csv_loader.position, self.loader.position)
+        self.assertDictEqual(
+            restored['year_month_location'],
+            data['year_month_location']
+        )
+        self.assertDictEqual(
+            restored['presence'].weekdays,
+            data['presence'].weekdays
+        )
+
+        self.append('12,2013-10-01,09:00:00,17:00:00,Pila\n')
+        csv_loader = loader.CSVLoader(loader.AGGREGATES)
+        data = csv_loader.load(self.path, snapshot_path)
+
+        self.assertItemsEqual(data['presence'].users(), [10, 11, 12])
+        self.assertEqual(
+            data['year_month_location']['2013-09']['Pila'],
+            76015
+        )
+
+    def test_load_snapshot_of_different_file(self):
+        """
+        Test ignoring snapshot built from different file.
+        """
+        snapshot_path = os.path.join(self.directory, 'data.snapshot')
+        self.loader.load(self.path, snapshot_path)
+        with open(self.path, 'r+') as csvfile:
+            csvfile.write('12')
+
+        csv_loader = loader.CSVLoader(loader.AGGREGATES)
+        data = csv_loader.load(self.path, snapshot_path)
+
+        self.assertItemsEqual(data['presence'].users(), [10, 11, 12])
+
+    def test_line_reader(self):
+        """
+        Test reading complete lines of a byte range.
+        """
+        self.append('12,2013-10')
+        with open(self.path, 'rb') as csvfile:
+            lines = loader.LineReader(csvfile, 0, 40)
+            self.assertEqual(len(list(lines)), 2)
+            self.assertEqual(lines.position, 76)
+
+            lines = loader.LineReader(csvfile, 76)
+            self.assertEqual(len(list(lines)), 7)
+            self.assertEqual(
+                lines.position,
+                os.path.getsize(self.path) - len('12,2013-10')
+            )
+
+    def test_split_chunks(self):
+        """
+        Test splitting file into chunks at line boundaries.
+        """
+        size = os.path.getsize(self.path)
+        with open(self.path, 'rb') as csvfile:
+            chunks = loader.split_chunks(csvfile, 0, size, 4)
+
+            self.assertEqual(chunks[0][0], 0)
+            self.assertEqual(chunks[-1][1], size)
+            for (_, stop), (start, _) in zip(chunks, chunks[1:]):
+                self.assertEqual(stop, start)
+                csvfile.seek(start - 1)
+                self.assertEqual(csvfile.read(1), '\n')
+
+            self.assertListEqual(
+                loader.split_chunks(csvfile, 0, size, 100)[-1:],
+                [(size - 37, size)]
+            )
+
+    def test_load_parallel(self):
+        """
+        Test parsing chunks of file in worker processes.
+        """
+        expected = self.loader.load(self.path)
+        self.loader = loader.CSVLoader(loader.AGGREGATES)
+        self.loader.parallel_size = 0
+
+        with mock.patch.object(loader, 'active_count', return_value=1):
+            data = self.loader.load(self.path, workers=3)
+
+        self.assertEqual(self.loader.position, os.path.getsize(self.path))
+        self.assertDictEqual(
+            data['year_month_location'],
+            expected['year_month_location']
+        )
+        self.assertListEqual(
+            [list(column) for column in data['presence'].columns()],
+            [list(column) for column in expected['presence'].columns()]
+        )
+        self.assertDictEqual(
+            data['presence'].weekdays,
+            expected['presence'].weekdays
+        )
+
+    def test_load_parallel_with_threads(self):
+        """
+        Test parsing in process while other threads run.
+        """
+        self.loader.parallel_size = 0
+
+        with mock.patch.object(loader, 'active_count', return_value=2), \
+                mock.patch.object(loader, 'parse_parallel') as parse_parallel:
+            data = self.loader.load(self.path, workers=3)
+
+        self.assertFalse(parse_parallel.called)
+        self.assertEqual(self.loader.position, os.path.getsize(self.path))
+        self.assertIn('presence', data)
+
+    def test_snapshot_loader(self):
+        """
+        Test attaching to snapshots published by a loader process.
+        """
+        snapshot_path = os.path.join(self.directory, 'data.snapshot')
+        self.loader.load(self.path, snapshot_path)
+        snapshot_loader = loader.SnapshotLoader(loader.AGGREGATES)
+
+        data = snapshot_loader.load(snapshot_path)
+
+        self.assertEqual(snapshot_loader.generation, 1)
+        self.assertItemsEqual(data['presence'].users(), [10, 11])
+        self.assertIsInstance(data['presence'].days, store.MappedColumn)
+        self.assertIs(snapshot_loader.load(snapshot_path), data)
+
+        self.append('12,2013-10-01,09:00:00,17:00:00,Pila\n')
+        self.loader.load(self.path, snapshot_path)
+        data = snapshot_loader.load(snapshot_path)
+
+        self.assertEqual(snapshot_loader.generation, 2)
+        self.assertItemsEqual(data['presence'].users(), [10, 11, 12])
+
+    def test_year_month_location_merge(self):
+        """
+        Test merging month and location totals.
+        """
+        previous = {'2013-09': {'Pila': 10}}
+
+        data = loader.YearMonthLocationAggregate.merge(
+            previous,
+            {'2013-09': {'Pila': 5, 'Lodz': 1}, '2013-10': {'Lodz': 2}}
+        )
+
+        self.assertDictEqual(
+            data,
+            {'2013-09': {'Pila': 15, 'Lodz': 1}, '2013-10': {'Lodz': 2}}
+        )
+        self.assertDictEqual(previous, {'2013-09': {'Pila': 10}})
+
+
+class PresenceAnalyzerSnapshotTestCase(unittest.TestCase):
+    """
+    Binary snapshot tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'data.snapshot')
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.directory)
+
+    def test_align(self):
+        """
+        Test aligning offsets.
+        """
+        self.assertEqual(snapshot.align(0), 0)
+        self.assertEqual(snapshot.align(1), 8)
+        self.assertEqual(snapshot.align(16), 16)
+
+    def test_source_digest(self):
+        """
+        Test digest of beginning and end of the source.
+        """
+        with open(TEST_DATA_CSV, 'rb') as source:
+            digest = snapshot.source_digest(source, 100)
+            self.assertEqual(digest, snapshot.source_digest(source, 100))
+            self.assertNotEqual(digest, snapshot.source_digest(source, 101))
+
+    def test_write_read_snapshot(self):
+        """
+        Test writing and mapping snapshot.
+        """
+        snapshot.write_snapshot(
+            self.path,
+            {'position': 10},
+            [('first', b'abc'), ('second', b'defgh')]
+        )
+
+        header, sections = snapshot.read_snapshot(self.path)
+
+        self.assertEqual(header['position'], 10)
+        self.assertEqual(header['version'], snapshot.VERSION)
+        self.assertEqual(str(sections['first']), b'abc')
+        self.assertEqual(str(sections['second']), b'defgh')
+        self.assertListEqual(os.listdir(self.directory), ['data.snapshot'])
+
+    def test_write_snapshot_mode(self):
+        """
+        Test keeping permissions of replaced snapshot.
+        """
+        umask = os.umask(0o022)
+        try:
+            snapshot.write_snapshot(self.path, {}, [])
+            self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o644)
+
+            os.chmod(self.path, 0o640)
+            snapshot.write_snapshot(self.path, {}, [])
+            self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o640)
+        finally:
+            os.umask(umask)
+
+    def test_read_invalid_snapshot(self):
+        """
+        Test reading file which is not a snapshot.
+        """
+        with open(self.path, 'wb') as output:
+            output.write(b'not a snapshot at all')
+
+        with self.assertRaises(snapshot.SnapshotError):
+            snapshot.read_snapshot(self.path)
+
+
+@unittest.skipUnless(vectorized.is_available(), 'NumPy is not installed')
+class PresenceAnalyzerVectorizedTestCase(unittest.TestCase):
+    """
+    Vectorised computations tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        self.store = utils.get_presence_store()
+
+    def test_as_array(self):
+        """
+        Test viewing arrays and mapped columns as NumPy arrays.
+        """
+        column = array('i', [5, 6, 7, 8])
+        mapped = store.MappedColumn('i', b'\0' * 8 + column.tostring(), 8, 4)
+
+        self.assertListEqual(
+            vectorized.as_array(column).tolist(),
+            [5, 6, 7, 8]
+        )
+        self.assertListEqual(
+            vectorized.as_array(mapped, 1, 3).tolist(),
+            [6, 7]
+        )
+        self.assertListEqual(vectorized.as_array(mapped, 3, 3).tolist(), [])
+
+    def test_weekday_totals(self):
+        """
+        Test summing entries by weekday, compared with pure Python version.
+        """
+        totals = vectorized.weekday_totals(
+            self.store.user_ids,
+            self.store.days,
+            self.store.starts,
+            self.store.ends,
+            self.store.index
+        )
+
+        self.assertDictEqual(
+            totals,
+            {
+                user_id: store.sum_by_weekday(
+                    self.store.days, self.store.starts, self.store.ends,
+                    begin, end
+                )
+                for user_id, (begin, end) in self.store.index.items()
+            }
+        )
+        self.assertIsInstance(totals[10][1][1], int)
+
+    def test_month_location_totals(self):
+        """
+        Test summing presence by month and location, compared with pure
+        Python version.
+        """
+        totals = self.store.month_location_totals()
+
+        user_totals = self.store.month_location_totals(10)
+
+        with mock.patch.object(vectorized, 'numpy', None):
+            self.assertDictEqual(totals, self.store.month_location_totals())
+            self.assertDictEqual(
+                user_totals,
+                self.store.month_location_totals(10)
+            )
+        self.assertDictEqual(totals, utils.get_year_month_location())
+
+
+class PresenceAnalyzerDirectoryTestCase(unittest.TestCase):
+    """
+    User directory tests.
+    """
+
+    def test_parse(self):
+        """
+        Test reading users from XML export.
+        """
+        users = directory.UserDirectory.parse(TEST_DATA_XML)
+
+        self.assertIsInstance(users, dict)
+        self.assertEqual(users.server, 'https://intranet.stxnext.pl:443')
+        self.assertItemsEqual(users.keys(), [10, 11])
+        self.assertDictEqual(
+            users[11],
+            {
+                'name': 'Maciej D.',
+                'avatar':
+                    'https://intranet.stxnext.pl:443/api/images/users/11',
+            }
+        )
+
+    def test_sort_key(self):
+        """
+        Test sorting names in Polish order.
+        """
+        names = [
+            'Żaneta', 'zenon', 'Ćwik', 'Lucyna', 'Czajka', 'Łukasz',
+            'Zenon', 'Źdźisław', 'Ólga', 'Olga', 'O\'Neill', 'Ewa-Maria',
+            'Ewa Anna',
+        ]
+
+        self.assertListEqual(
+            sorted(names, key=directory.sort_key),
+            [
+                'Czajka', 'Ćwik', 'Ewa Anna', 'Ewa-Maria', 'Lucyna',
+                'Łukasz', 'Olga', 'O\'Neill', 'Ólga', 'zenon', 'Zenon',
+                'Źdźisław', 'Żaneta',
+            ]
+        )
+        self.assertEqual(
+            directory.collation_key('Ab. Ć'),
+            directory.collation_key('abć')
+        )
+
+    def test_search(self):
+        """
+        Test listing users sorted by name and searching them by prefix.
+        """
+        users = directory.UserDirectory({
+            1: {'name': 'Łukasz K.', 'avatar': ''},
+            2: {'name': 'Lucyna B.', 'avatar': ''},
+            3: {'name': 'Łucja A.', 'avatar': ''},
+            4: {'name': 'Adam P.', 'avatar': ''},
+        })
+
+        self.assertListEqual(users.sorted_ids, [4, 2, 3, 1])
+        self.assertListEqual(
+            users.listing(1, 3),
+            [
+                {'user_id': 2, 'name': 'Lucyna B.'},
+                {'user_id': 3, 'name': 'Łucja A.'},
+            ]
+        )
+        self.assertEqual(users.search(), (0, 4))
+        self.assertEqual(users.search('ł'), (2, 4))
+        self.assertEqual(users.search('łu'), (2, 4))
+        self.assertEqual(users.search('ŁUK'), (3, 4))
+        self.assertEqual(users.search('l'), (1, 2))
+        self.assertEqual(users.search('x'), (4, 4))
+
+    def test_joined_users(self):
+        """
+        Test read-only join of users with presence store.
+        """
+        users = directory.UserDirectory({
+            10: {'name': 'Adam P.', 'avatar': 'http://intranet/10'},
+            12: {'name': 'Ewa K.', 'avatar': 'http://intranet/12'},
+        })
+        presence = store.PresenceStore.from_columns(
+            array('i', [10]),
+            array('i', [datetime.date(2013, 10, 1).toordinal()]),
+            array('i', [32400]),
+            array('i', [61200]),
+            array('H', [0]),
+            ['Pila']
+        )
+        joined = directory.JoinedUsers(users, presence)
+
+        self.assertEqual(len(joined), 2)
+        self.assertItemsEqual(list(joined), [10, 12])
+        self.assertFalse(hasattr(joined[10], '__dict__'))
+        self.assertEqual(joined[10].name, 'Adam P.')
+        self.assertEqual(joined[10]['avatar'], 'http://intranet/10')
+        self.assertEqual(
+            joined[10].weekday_totals()[1],
+            (1, 28800, 32400, 61200)
+        )
+        self.assertDictEqual(joined[12].presence, {})
+        self.assertRaises(KeyError, joined[10].__getitem__, 'user_id')
+        self.assertDictEqual(
+            joined.as_dict()[10],
+            {
+                'name': 'Adam P.',
+                'avatar': 'http://intranet/10',
+                'presence': {
+                    datetime.date(2013, 10, 1): {
+                        'start': datetime.time(9, 0),
+                        'end': datetime.time(17, 0),
+                    },
+                },
+            }
+        )
+        self.assertDictEqual(
+            users[10],
+            {'name': 'Adam P.', 'avatar': 'http://intranet/10'}
+        )
+
+    def test_parse_server_after_users(self):
+        """
+        Test reading users listed before the server.
+        """
+        export = io.BytesIO(
+            b'<intranet><users>'
+            b'<user id="7"><avatar>/img/7</avatar><name>Ewa \xc5\x81.</name>'
+            b'</user><user id="8"><name>Jan K.</name></user>'
+            b'</users><server><host>intranet</host><port>80</port>'
+            b'<protocol>http</protocol></server></intranet>'
+        )
+        users = directory.UserDirectory.parse(export)
+
+        self.assertDictEqual(
+            users,
+            {
+                7: {
+                    'name': 'Ewa \u0141.',
+                    'avatar': 'http://intranet:80/img/7',
+                },
+                8: {'name': 'Jan K.', 'avatar': 'http://intranet:80'},
+            }
+        )
+
+
+class PresenceAnalyzerSchedulerTestCase(unittest.TestCase):
+    """
+    Background refresh tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'data.csv')
+        main.app.config['TEST_SOURCE'] = self.path
+        self.calls = []
+        self.errors = []
+
+        @utils.Cache(sources=('TEST_SOURCE',))
+        def dataset():
+            """
+            Dataset to refresh.
+            """
+            if self.errors:
+                raise self.errors.pop()
+            self.calls.append(None)
+            return len(self.calls)
+
+        self.dataset = dataset
+        self.scheduler = scheduler.Scheduler(
+            [dataset], interval=10, watch_interval=0.01, jitter=0.5,
+            max_backoff=30
+        )
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        self.scheduler.stop()
+        shutil.rmtree(self.directory)
+        del main.app.config['TEST_SOURCE']
+
+    def test_run_once(self):
+        """
+        Test refreshing datasets in both modes.
+        """
+        self.scheduler.mode = 'watch'
+        self.assertTrue(self.scheduler.run_once())
+        self.assertTrue(self.scheduler.run_once())
+        self.assertEqual(len(self.calls), 1)
+
+        self.scheduler.mode = 'interval'
+        self.assertTrue(self.scheduler.run_once())
+        self.assertEqual(len(self.calls), 2)
+
+        self.errors.append(IOError('No such file'))
+        self.assertFalse(self.scheduler.run_once())
+        self.assertEqual(self.dataset(), 2)
+
+        status = self.scheduler.status()
+        self.assertEqual(status['runs'], 4)
+        self.assertEqual(status['failures'], 1)
+        self.assertIsNone(status['mode'])
+        self.assertEqual(
+            status['datasets']['dataset']['last_error'],
+            'IOError: No such file'
+        )
+
+    def test_delay(self):
+        """
+        Test spreading delays and backing off after failures.
+        """
+        self.scheduler.mode = 'interval'
+        for _ in range(20):
+            self.assertTrue(5 <= self.scheduler.delay() <= 15)
+
+        self.scheduler.failures = 1
+        self.assertTrue(10 <= self.scheduler.delay() <= 30)
+        self.scheduler.failures = 5
+        self.assertTrue(15 <= self.scheduler.delay() <= 45)
+
+        self.scheduler.mode = 'watch'
+        self.scheduler.failures = 0
+        self.assertTrue(self.scheduler.delay() <= 0.015)
+
+    def test_start(self):
+        """
+        Test refreshing datasets in background thread.
+        """
+        self.dataset()
+        self.scheduler.start('watch')
+        self.assertTrue(self.dataset.cache.scheduled)
+        self.assertEqual(self.scheduler.status()['mode'], 'watch')
+
+        with open(self.path, 'w') as source:
+            source.write('data')
+        self.assertEqual(self.dataset(), 1)
+        for _ in range(500):
+            if len(self.calls) == 2:
+                break
+            threading.Event().wait(0.01)
+        self.assertEqual(self.dataset(), 2)
+
+        self.scheduler.stop()
+        self.assertFalse(self.dataset.cache.scheduled)
+        self.assertIsNone(self.scheduler.status()['next_run'])
+        self.assertRaises(ValueError, self.scheduler.start, 'hourly')
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Handler of stand-in HTTP server replaying responses set by the test.
+    """
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """
+        Sends next response, or 304 when the client has current version.
+        """
+        server = self.server
+        server.requests.append(dict(self.headers))
+        status, body, headers = server.responses.pop(0)
+
+        if status == 200 and 'ETag' in headers and \
+                self.headers.get('If-None-Match') == headers['ETag']:
+            status, body = 304, b''
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if 'Content-Length' not in headers:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        """
+        Keeps test output quiet.
+        """
+
+
+class PresenceAnalyzerDownloadTestCase(unittest.TestCase):
+    """
+    Downloads tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.server = BaseHTTPServer.HTTPServer(
+            ('127.0.0.1', 0), StandInHandler
+        )
+        self.server.requests = []
+        self.server.responses = []
+        self.url = 'http://127.0.0.1:{}/users.xml'.format(
+            self.server.server_port
+        )
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'users.xml')
+        with open(TEST_DATA_XML, 'rb') as xml:
+            self.xml = xml.read()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def test_download(self):
+        """
+        Test downloading file and skipping unchanged one.
+        """
+        self.server.responses = [
+            (200, self.xml, {'ETag': '"v1"'}),
+            (200, self.xml, {'ETag': '"v1"'}),
+            (200, b'<intranet/>', {'ETag': '"v2"'}),
+        ]
+
+        self.assertTrue(download.download(self.url, self.path))
+        with open(self.path, 'rb') as xml:
+            self.assertEqual(xml.read(), self.xml)
+
+        self.assertFalse(download.download(self.url, self.path))
+        self.assertEqual(
+            self.server.requests[1].get('if-none-match'),
+            '"v1"'
+        )
+
+        self.assertTrue(download.download(self.url, self.path))
+        with open(self.path, 'rb') as xml:
+            self.assertEqual(xml.read(), b'<intranet/>')
+        self.assertEqual(download.read_validators(self.path)['etag'], '"v2"')
+        self.assertItemsEqual(
+            os.listdir(self.directory),
+            ['users.xml', 'users.xml.http']
+        )
+
+    def test_download_mode(self):
+        """
+        Test keeping permissions of replaced file.
+        """
+        self.server.responses = [(200, self.xml, {})]
+        with open(self.path, 'wb') as xml:
+            xml.write(b'<intranet/>')
+        os.chmod(self.path, 0o644)
+
+        self.assertTrue(download.download(self.url, self.path))
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o644)
+
+    def test_download_retries(self):
+        """
+        Test retrying failed and incomplete downloads.
+        """
+        self.server.responses = [
+            (503, b'', {}),
+            (200, self.xml[:50], {'Content-Length': str(len(self.xml))}),
+            (200, self.xml, {}),
+        ]
+
+        self.assertTrue(
+            download.download(self.url, self.path, backoff=0, retries=2)
+        )
+        self.assertEqual(len(self.server.requests), 3)
+        with open(self.path, 'rb') as xml:
+            self.assertEqual(xml.read(), self.xml)
+
+    def test_download_errors(self):
+        """
+        Test keeping old file when download fails or data is invalid.
+        """
+        with open(self.path, 'wb') as xml:
+            xml.write(self.xml)
+        self.server.responses = [
+            (500, b'', {}),
+            (500, b'', {}),
+            (404, b'', {}),
+            (200, b'<intranet><users>', {}),
+        ]
+
+        self.assertRaises(
+            download.DownloadError,
+            download.download, self.url, self.path, retries=1, backoff=0
+        )
+        self.assertRaises(
+            download.DownloadError,
+            download.download, self.url, self.path, backoff=0
+        )
+        self.assertRaises(
+            etree.XMLSyntaxError,
+            download.download, self.url, self.path,
+            validate=directory.UserDirectory.parse
+        )
+        self.assertEqual(len(self.server.requests), 4)
+        self.assertListEqual(os.listdir(self.directory), ['users.xml'])
+        with open(self.path, 'rb') as xml:
+            self.assertEqual(xml.read(), self.xml)
+
+    def test_download_timeout(self):
+        """
+        Test giving up on server that does not respond.
+        """
+        self.server.shutdown()
+        self.server.server_close()
+        silent = socket.socket()
+        silent.bind(('127.0.0.1', 0))
+        silent.listen(1)
+        url = 'http://127.0.0.1:{}/'.format(silent.getsockname()[1])
+
+        try:
+            self.assertRaises(
+                download.DownloadError,
+                download.download, url, self.path,
+                timeout=0.1, retries=1, backoff=0
+            )
+        finally:
+            silent.close()
+        self.assertFalse(os.path.exists(self.path))
 
 
 def suite():
@@ -497,7 +2689,15 @@ def suite():
     """
     base_suite = unittest.TestSuite()
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerViewsTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerHelpersTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerDirectoryTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerDownloadTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerSchedulerTestCase))
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerUtilsTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerStoreTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerCSVLoaderTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerSnapshotTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerVectorizedTestCase))
     return base_suite
 
 
@@ -2,32 +2,281 @@
 """
 Helper functions used in views.
 """
+import os
 from calendar import day_abbr
-from csv import reader
+from collections import OrderedDict
 from datetime import datetime
-from functools import wraps
+from functools import partial, wraps
 from json import dumps
 from logging import getLogger
-from threading import Lock
+from threading import Event, Lock, Thread
 
-from flask import Response
-from lxml import etree
+from flask import Response, abort, request
 
+from presence_analyzer.directory import JoinedUsers, UserDirectory
+from presence_analyzer.loader import (
+    AGGREGATES,
+    CSVLoader,
+    SnapshotLoader,
+    parse_date,
+)
 from presence_analyzer.main import app
+from presence_analyzer.scheduler import Scheduler
+from presence_analyzer.snapshot import SnapshotError
+from presence_analyzer.store import LocationIndex, month_number
 
 
 log = getLogger(__name__)  # pylint: disable=invalid-name
 
 
+def get_sources_signature(sources):
+    """
+    Returns paths, inodes, sizes and modification times of files stored
+    under given app.config keys. Missing files and keys are marked with None.
+    """
+    signature = []
+
+    for source in sources:
+        path = app.config.get(source)
+        if path is None:
+            signature.append((source, None))
+            continue
+        try:
+            stat = os.stat(path)
+        except OSError:
+            signature.append((path, None))
+        else:
+            signature.append(
+                (path, stat.st_ino, stat.st_size, stat.st_mtime)
+            )
+
+    return tuple(signature)
+
+
+class CacheEntry(object):
+    """
+    Cached result of a single call.
+    """
+    __slots__ = ('data', 'signature', 'last_update')
+
+    def __init__(self, data, signature, last_update):
+        self.data = data
+        self.signature = signature
+        self.last_update = last_update
+
+
 class Cache(object):
     """
-    Decorator that caches data for a given time.
+    Decorator that caches data for a given time or until source files change.
+
+    Sources are app.config keys of files the data is built from, or
+    a function returning them when they depend on configuration. When they
+    are given, data is rebuilt exactly when any of the files changes, which
+    is checked with os.stat on every call, and the time limit is not used.
+    Without sources and time limit, cached data never expires.
+
+    With stale_while_revalidate, outdated data is returned immediately while
+    a single background thread rebuilds it and swaps it in.
+
+    By default arguments are ignored and a single result is cached. With
+    maxsize, results are cached per call arguments and least recently used
+    entries are evicted above maxsize entries.
+
+    Data is built outside of the lock, so slow builds do not block calls
+    for other arguments, and only once at a time per arguments: calls
+    finding a build in progress wait for its result.
+
+    When `scheduled` is set, calls return cached data without checking it
+    and data is rebuilt only by calling `refresh` of the decorated function.
     """
-    def __init__(self, seconds):
-        self.cached_data = None
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, seconds=None, sources=(), stale_while_revalidate=False,
+                 maxsize=None):
         self.duration = seconds
-        self.last_update = None
+        self.sources = sources
+        self.stale_while_revalidate = stale_while_revalidate
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
         self.thread_lock = Lock()
+        self.builds = {}
+        self.generation = 0
+        self.refresh_threads = {}
+        self.last_update = None
+        self.refreshes = 0
+        self.refresh_duration = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stale_hits = 0
+        self.scheduled = False
+
+    def make_key(self, args, kwargs):
+        """
+        Returns key of cache entry for given call arguments.
+        """
+        if self.maxsize is None:
+            return None
+        return args, tuple(sorted(kwargs.items()))
+
+    def signature(self):
+        """
+        Returns current signature of source files.
+        """
+        sources = self.sources() if callable(self.sources) else self.sources
+        return get_sources_signature(sources)
+
+    def is_valid(self, entry, signature):
+        """
+        Checks if cached entry can be still used.
+        """
+        if self.sources:
+            return signature == entry.signature
+        if self.duration is None:
+            return True
+
+        time_diff = datetime.now() - entry.last_update
+        return int(time_diff.total_seconds()) < self.duration
+
+    def build(self, function, args, kwargs):
+        """
+        Calls decorated function, returns its result and duration of the call.
+        """
+        # pylint: disable=no-self-use
+        started = datetime.now()
+        data = function(*args, **kwargs)
+        duration = (datetime.now() - started).total_seconds()
+        log.info('Built %s in %.3f s', function.__name__, duration)
+
+        return data, duration
+
+    def update(self, key, data, signature, duration):
+        """
+        Swaps in rebuilt data, must be called with the lock held.
+        """
+        self.last_update = datetime.now()
+        self.entries.pop(key, None)
+        self.entries[key] = CacheEntry(data, signature, self.last_update)
+        self.refreshes += 1
+        self.refresh_duration = duration
+
+        while self.maxsize is not None and len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def start_build(self, key):
+        """
+        Registers build of data for given key, unless one is in progress,
+        must be called with the lock held.
+
+        Returns: (Event) - set when the build in progress finishes, None if
+        the build was registered and must be finished with `finish_build`.
+        """
+        building = self.builds.get(key)
+        if building is not None:
+            return building[0]
+
+        self.builds[key] = Event(), self.generation
+        return None
+
+    def finish_build(self, function, args, kwargs, signature):
+        """
+        Builds data registered with `start_build` outside of the lock, swaps
+        it in and wakes up calls waiting for it.
+        """
+        key = self.make_key(args, kwargs)
+        try:
+            data, duration = self.build(function, args, kwargs)
+        except Exception:
+            with self.thread_lock:
+                self.builds.pop(key)[0].set()
+            raise
+
+        with self.thread_lock:
+            building, generation = self.builds.pop(key)
+            if generation == self.generation:
+                self.update(key, data, signature, duration)
+            building.set()
+        return data
+
+    def refresh_in_background(self, function, args, kwargs, signature):
+        """
+        Rebuilds cached data in a thread, keeping old data on errors.
+        """
+        try:
+            self.finish_build(function, args, kwargs, signature)
+        except Exception:  # pylint: disable=broad-except
+            log.exception('Refreshing %s failed', function.__name__)
+
+        with self.thread_lock:
+            del self.refresh_threads[self.make_key(args, kwargs)]
+
+    def refresh(self, function, args=(), kwargs=None, force=False):
+        """
+        Rebuilds data cached for given call arguments in the calling thread,
+        if it is outdated or `force` is set, and swaps it in. Waits for
+        a build in progress first, so data is never built twice at a time.
+
+        Returns: (bool) - True if data was rebuilt.
+        """
+        # pylint: disable=too-many-arguments
+        kwargs = kwargs or {}
+        key = self.make_key(args, kwargs)
+
+        while True:
+            with self.thread_lock:
+                signature = self.signature()
+                entry = self.entries.get(key)
+                if entry is not None and not force and \
+                        self.is_valid(entry, signature):
+                    return False
+                building = self.start_build(key)
+
+            if building is None:
+                break
+            building.wait()
+
+        self.finish_build(function, args, kwargs, signature)
+        return True
+
+    def version(self, *args, **kwargs):
+        """
+        Returns signature of sources of data currently cached for given call
+        arguments, or time of its last update when there are no sources.
+        Returns None if nothing is cached.
+        """
+        with self.thread_lock:
+            entry = self.entries.get(self.make_key(args, kwargs))
+
+        if entry is None:
+            return None
+        return entry.signature or entry.last_update.isoformat()
+
+    def clear(self):
+        """
+        Drops all cached entries, data of builds in progress is not cached.
+        """
+        with self.thread_lock:
+            self.entries.clear()
+            self.generation += 1
+
+    def stats(self):
+        """
+        Returns refresh and usage metrics.
+        """
+        return {
+            'last_update': (
+                self.last_update.isoformat() if self.last_update else None
+            ),
+            'refreshes': self.refreshes,
+            'refresh_duration': self.refresh_duration,
+            'stale_hits': self.stale_hits,
+            'refreshing': bool(self.refresh_threads),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self.entries),
+        }
 
     def __call__(self, function):
         """
@@ -38,18 +287,44 @@ class Cache(object):
             """
             Returns decorated data.
             """
-            with self.thread_lock:
-                if self.last_update is None:
-                    self.cached_data = function(*args, **kwargs)
-                    self.last_update = datetime.now()
-                else:
-                    time_diff = datetime.now() - self.last_update
-                    elapsed_seconds = int(time_diff.total_seconds())
-                    if elapsed_seconds >= self.duration:
-                        self.cached_data = function(*args, **kwargs)
-                        self.last_update = None
-
-            return self.cached_data
+            key = self.make_key(args, kwargs)
+            while True:
+                with self.thread_lock:
+                    signature = self.signature()
+                    entry = self.entries.get(key)
+
+                    if entry is not None and (
+                            self.scheduled or self.is_valid(entry, signature)):
+                        self.hits += 1
+                        if self.maxsize is not None:
+                            self.entries[key] = self.entries.pop(key)
+                        return entry.data
+
+                    if entry is not None and self.stale_while_revalidate:
+                        self.stale_hits += 1
+                        if self.start_build(key) is None:
+                            thread = Thread(
+                                target=self.refresh_in_background,
+                                args=(function, args, kwargs, signature),
+                                name='refresh-{}'.format(function.__name__),
+                            )
+                            thread.daemon = True
+                            self.refresh_threads[key] = thread
+                            thread.start()
+                        return entry.data
+
+                    building = self.start_build(key)
+                    if building is None:
+                        self.misses += 1
+
+                if building is None:
+                    return self.finish_build(
+                        function, args, kwargs, signature
+                    )
+                building.wait()
+
+        wrapper.cache = self
+        wrapper.refresh = partial(self.refresh, function)
         return wrapper
 
 
@@ -69,7 +344,65 @@ def jsonify(function):
     return inner
 
 
-@Cache(600)
+csv_loader = CSVLoader(AGGREGATES)  # pylint: disable=invalid-name
+
+snapshot_loader = SnapshotLoader(AGGREGATES)  # pylint: disable=invalid-name
+
+
+def refresh_snapshot():
+    """
+    Loads aggregates from CSV file and publishes them in the snapshot.
+    """
+    return csv_loader.load(
+        app.config['DATA_CSV'],
+        app.config['DATA_SNAPSHOT'],
+        app.config.get('PARSE_WORKERS', 1)
+    )
+
+
+def get_aggregates_sources():
+    """
+    Returns app.config keys of files aggregates are built from. Snapshot is
+    a source only when it is published by `refresh_data`, as otherwise it
+    is written by the process itself after each build.
+    """
+    if app.config.get('DATA_PLANE') == 'shared':
+        return 'DATA_CSV', 'DATA_SNAPSHOT'
+    return 'DATA_CSV',
+
+
+@Cache(sources=get_aggregates_sources, stale_while_revalidate=True)
+def get_aggregates():
+    """
+    Reads CSV file once and feeds every row to all registered aggregates.
+    Aggregates are refreshed when the file changes, reading only rows
+    appended to it since. When DATA_SNAPSHOT is configured, aggregates are
+    saved to it and restored from it on startup.
+
+    With DATA_PLANE set to "shared", aggregates are not built by the process,
+    but attached read-only from the snapshot published by `refresh_data`.
+
+    Returns: (dict) - with results of aggregates, keyed by aggregate name.
+    """
+    if app.config.get('DATA_PLANE') == 'shared':
+        try:
+            return snapshot_loader.load(app.config['DATA_SNAPSHOT'])
+        except (IOError, OSError, KeyError, SnapshotError):
+            log.warning(
+                'Snapshot not available, loading CSV file', exc_info=True
+            )
+            return csv_loader.load(
+                app.config['DATA_CSV'],
+                workers=app.config.get('PARSE_WORKERS', 1)
+            )
+
+    return csv_loader.load(
+        app.config['DATA_CSV'],
+        app.config.get('DATA_SNAPSHOT'),
+        app.config.get('PARSE_WORKERS', 1)
+    )
+
+
 def get_data():
     """
     Extracts presence data from CSV file and groups it by user_id.
@@ -87,28 +420,18 @@ def get_data():
             },
         }
     }
-    """
-    data = {}
-
-    with open(app.config['DATA_CSV'], 'r') as csvfile:
-        presence_reader = reader(csvfile, delimiter=',')
 
-        for i, row in enumerate(presence_reader):
-            if len(row) != 5:
-                # ignore header and footer lines
-                continue
-
-            try:
-                user_id = int(row[0])
-                date = datetime.strptime(row[1], '%Y-%m-%d').date()
-                start = datetime.strptime(row[2], '%H:%M:%S').time()
-                end = datetime.strptime(row[3], '%H:%M:%S').time()
-            except (ValueError, TypeError):
-                log.debug('Problem with line %d: ', i, exc_info=True)
+    The structure is built on each call from the cached PresenceStore, use
+    get_presence_store() on hot paths.
+    """
+    return get_presence_store().as_dict()
 
-            data.setdefault(user_id, {})[date] = {'start': start, 'end': end}
 
-    return data
+def get_presence_store():
+    """
+    Returns PresenceStore with presence data from CSV file.
+    """
+    return get_aggregates()['presence']
 
 
 def group_by_weekday(items):
@@ -146,6 +469,115 @@ def mean(items):
     return float(sum(items)) / len(items) if len(items) > 0 else 0
 
 
+def average(total, count):
+    """
+    Calculates arithmetic mean from total and count. Returns zero for zero
+    count.
+    """
+    return float(total) / count if count > 0 else 0
+
+
+def get_date_range():
+    """
+    Returns ordinals of days given in `from` and `to` query parameters of
+    the current request, None for missing ones. Aborts with 400 Bad Request
+    when dates are invalid.
+    """
+    result = []
+
+    for name in ('from', 'to'):
+        value = request.args.get(name)
+        if not value:
+            result.append(None)
+            continue
+        try:
+            result.append(parse_date(value).toordinal())
+        except ValueError:
+            log.debug('Invalid date %s', value)
+            abort(400)
+
+    return tuple(result)
+
+
+def get_month_range():
+    """
+    Returns numbers of months given in `from` and `to` query parameters in
+    YYYY-MM format, or months of the year given in `year`, None for missing
+    ones. Aborts with 400 Bad Request when months are invalid.
+    """
+    year = request.args.get('year')
+    try:
+        if year:
+            return month_number(year + '-01'), month_number(year + '-12')
+        return tuple(
+            month_number(request.args[name]) if request.args.get(name)
+            else None
+            for name in ('from', 'to')
+        )
+    except ValueError:
+        log.debug('Invalid months %s', request.args)
+        abort(400)
+
+
+def get_user_ids(store):
+    """
+    Returns user ids given in `users` query parameter, as comma separated
+    ids or "all" for all users of the store. Aborts with 400 Bad Request
+    when ids are invalid.
+    """
+    users = request.args.get('users', '')
+    if users == 'all':
+        return store.users()
+
+    try:
+        return [int(user_id) for user_id in users.split(',')]
+    except ValueError:
+        log.debug('Invalid users %s', users)
+        abort(400)
+
+
+def mean_time_weekday(weekdays):
+    """
+    Returns mean presence time by weekday from per-weekday totals.
+    """
+    return [
+        (day_abbr[weekday], average(intervals, count))
+        for weekday, (count, intervals, _, _) in enumerate(weekdays)
+    ]
+
+
+def presence_weekday(weekdays):
+    """
+    Returns total presence time by weekday from per-weekday totals, with
+    a header row for the chart.
+    """
+    result = [
+        (day_abbr[weekday], intervals)
+        for weekday, (_, intervals, _, _) in enumerate(weekdays)
+    ]
+    result.insert(0, ('Weekday', 'Presence (s)'))
+
+    return result
+
+
+def presence_start_end(weekdays):
+    """
+    Returns mean start and end of presence by weekday from per-weekday
+    totals.
+    """
+    return [
+        [day_abbr[weekday], average(starts, count), average(ends, count)]
+        for weekday, (count, _, starts, ends) in enumerate(weekdays)
+    ]
+
+
+WEEKDAY_METRICS = OrderedDict([
+    ('mean_time_weekday', mean_time_weekday),
+    ('presence_weekday', presence_weekday),
+    ('presence_start_end', presence_start_end),
+])
+
+
 def group_by_weekday_start_end(items):
     """
     Groups the beginnings of the ends of presence entries by weekday.
@@ -181,11 +613,13 @@ def get_user_data(user, url):
     }
 
 
+@Cache(sources=('DATA_XML',), stale_while_revalidate=True)
 def get_users_avatar_name():
     """
-    Creates a dictionary with users' full info.
+    Reads users' full info from XML file, which is re-read only when the
+    file changes.
 
-    Returns: (dict) - with user data, like:
+    Returns: (UserDirectory) - dict with user data, like:
     {
         'user_id_0': {
             'name': 'Kajetan O.',
@@ -198,30 +632,16 @@ def get_users_avatar_name():
         ...
     }
     """
-    all_users_data = {}
-    etree_users = etree.parse(app.config['DATA_XML'])
-
-    etree_server = etree_users.find('server')
-    server_address = '{}://{}:{}'.format(
-        etree_server.find('protocol').text,
-        etree_server.find('host').text,
-        etree_server.find('port').text
-    )
-
-    users = etree_users.find('users').xpath('//user')
-    for user in users:
-        user_data = get_user_data(user, server_address)
-        all_users_data[user_data['id']] = user_data['data']
-
-    return all_users_data
+    return UserDirectory.parse(app.config['DATA_XML'])
 
 
 def get_full_users_data():
     """
-    Creates a dictionary with users' full info and presence data from XML
-    and CSV file and groups it by user_id.
+    Joins users' full info and presence data from XML and CSV file by
+    user_id, without copying or changing the cached data.
 
-    Returns: (dict) - with users' data, like:
+    Returns: (JoinedUsers) - mapping of user_id to JoinedUser, which
+    converts with as_dict() to users' data like:
     {
         'user_id': {
             'name': 'Kajetan O.',
@@ -241,16 +661,9 @@ def get_full_users_data():
         ...
     }
     """
-    users_info = get_users_avatar_name()
-    users_data = get_data()
+    return JoinedUsers(get_users_avatar_name(), get_presence_store())
 
-    for user_id in users_info:
-        users_info[user_id]['presence'] = users_data.setdefault(user_id, {})
 
-    return users_info
-
-
-@Cache(600)
 def get_year_month_location():
     """
     Extracts presence data from CSV file and groups it by month.
@@ -269,27 +682,89 @@ def get_year_month_location():
         ...
     }
     """
-    data = {}
+    return get_aggregates()['year_month_location']
+
+
+_location_index = [None, None]  # pylint: disable=invalid-name
+
+
+def get_location_index():
+    """
+    Returns LocationIndex of presence time of all users by month and
+    location, built once for every version of get_year_month_location(),
+    so totals of any range of months add up every row of the CSV file.
+    """
+    totals = get_year_month_location()
+    indexed, index = _location_index
+    if indexed is not totals:
+        index = LocationIndex(totals)
+        _location_index[:] = [totals, index]
+    return index
+
 
-    with open(app.config['DATA_CSV'], 'r') as csvfile:
-        presence_reader = reader(csvfile, delimiter=',')
+DATASETS = (get_aggregates, get_users_avatar_name)
 
-        for i, row in enumerate(presence_reader):
-            if len(row) != 5:
-                # ignore header and footer lines
-                continue
+warm_up_status = {  # pylint: disable=invalid-name
+    'state': 'disabled',
+    'duration': None,
+}
 
-            try:
-                year_month = row[1][:-3]
-                start = datetime.strptime(row[2], '%H:%M:%S').time()
-                end = datetime.strptime(row[3], '%H:%M:%S').time()
-                location = row[4]
 
-                data.setdefault(year_month, {})
-                data[year_month].setdefault(location, 0)
-                data[year_month][location] += interval(start, end)
+def warm_up():
+    """
+    Loads all cached datasets and records how long it took.
+    """
+    warm_up_status.update(state='running', duration=None)
+    started = datetime.now()
+
+    try:
+        for function in DATASETS:
+            function()
+    except Exception:  # pylint: disable=broad-except
+        log.exception('Warm-up failed')
+        warm_up_status['state'] = 'failed'
+        return
+
+    warm_up_status.update(
+        state='ready',
+        duration=(datetime.now() - started).total_seconds(),
+    )
+    log.info('Warm-up finished in %.3f s', warm_up_status['duration'])
 
-            except (ValueError, TypeError):
-                log.debug('Problem with line %d: ', i, exc_info=True)
 
-    return data
+def start_warm_up(mode):
+    """
+    Starts warm-up of cached datasets.
+
+    Mode is 'sync' to load datasets before returning, 'background' to load
+    them in a separate thread or None to load them on first request.
+    """
+    if mode == 'sync':
+        warm_up()
+    elif mode == 'background':
+        warm_up_status['state'] = 'running'
+        thread = Thread(target=warm_up, name='warm-up')
+        thread.daemon = True
+        thread.start()
+    elif mode is not None:
+        raise ValueError('Unknown warm-up mode: {!r}'.format(mode))
+
+
+scheduler = Scheduler(DATASETS)  # pylint: disable=invalid-name
+
+
+def start_scheduler(mode):
+    """
+    Starts background refresh of cached datasets, configured by
+    REFRESH_INTERVAL, REFRESH_JITTER and REFRESH_MAX_BACKOFF.
+
+    Mode is 'interval' to rebuild datasets periodically, 'watch' to rebuild
+    them when their source files change or None to refresh them on requests.
+    """
+    if mode is None:
+        return
+
+    scheduler.interval = app.config.get('REFRESH_INTERVAL', 60)
+    scheduler.jitter = app.config.get('REFRESH_JITTER', 0.1)
+    scheduler.max_backoff = app.config.get('REFRESH_MAX_BACKOFF', 600)
+    scheduler.start(mode)
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Vectorised computations over columns of presence store, used when NumPy
+is installed.
+"""
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None  # pylint: disable=invalid-name
+
+
+UNIX_EPOCH_ORDINAL = 719163  # datetime.date(1970, 1, 1).toordinal()
+
+
+def is_available():
+    """
+    Checks if NumPy is installed.
+    """
+    return numpy is not None
+
+
+def as_array(column, begin=0, end=None):
+    """
+    Returns NumPy view of given range of array or MappedColumn, without
+    copying data.
+    """
+    dtype = numpy.dtype(column.typecode)
+    end = len(column) if end is None else end
+    if end <= begin:
+        return numpy.empty(0, dtype)
+
+    data = getattr(column, 'data', column)
+    offset = getattr(column, 'offset', 0)
+    return numpy.frombuffer(
+        data,
+        dtype,
+        count=end - begin,
+        offset=offset + begin * dtype.itemsize
+    )
+
+
+def weekday_totals(user_ids, days, starts, ends, index):
+    """
+    Sums entries of every user by weekday.
+
+    Returns: (dict) - with (count, intervals, starts, ends) sums for every
+    weekday, Monday first, keyed by user_id, like sum_by_weekday.
+    """
+    # pylint: disable=too-many-arguments
+    users = sorted(index)
+    if not users:
+        return {}
+
+    starts = as_array(starts).astype(numpy.int64)
+    ends = as_array(ends).astype(numpy.int64)
+    keys = (
+        numpy.searchsorted(users, as_array(user_ids)) * 7 +
+        (as_array(days) - 1) % 7
+    )
+    size = len(users) * 7
+
+    totals = numpy.column_stack([
+        numpy.bincount(keys, minlength=size),
+        numpy.bincount(keys, weights=ends - starts, minlength=size),
+        numpy.bincount(keys, weights=starts, minlength=size),
+        numpy.bincount(keys, weights=ends, minlength=size),
+    ]).astype(numpy.int64).reshape(len(users), 7, 4).tolist()
+
+    return {
+        user_id: [tuple(weekday) for weekday in totals[i]]
+        for i, user_id in enumerate(users)
+    }
+
+
+def month_location_totals(days, starts, ends, locations, location_names,
+                          begin=0, end=None):
+    """
+    Sums presence time of given range of entries by month and location.
+
+    Returns: (dict) - with totals like get_year_month_location.
+    """
+    # pylint: disable=too-many-arguments, too-many-locals
+    days = as_array(days, begin, end)
+    if not len(days):  # pylint: disable=len-as-condition
+        return {}
+
+    months = (
+        (days - UNIX_EPOCH_ORDINAL).astype('datetime64[D]')
+        .astype('datetime64[M]').astype(numpy.int64)
+    )
+    first = months.min()
+    keys = (
+        (months - first) * len(location_names) +
+        as_array(locations, begin, end)
+    )
+    intervals = (
+        as_array(ends, begin, end).astype(numpy.int64) -
+        as_array(starts, begin, end)
+    )
+    counts = numpy.bincount(keys)
+    totals = numpy.bincount(keys, weights=intervals).astype(numpy.int64)
+
+    result = {}
+    for key in numpy.flatnonzero(counts).tolist():
+        month, code = divmod(key, len(location_names))
+        year, month = divmod(first + month, 12)
+        year_month = '{:04d}-{:02d}'.format(1970 + year, month + 1)
+        result.setdefault(year_month, {})[location_names[code]] = int(
+            totals[key]
+        )
+
+    return result
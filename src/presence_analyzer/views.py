@@ -2,25 +2,49 @@
 """
 Defines views.
 """
-import locale
+import mimetypes
 import operator
-from calendar import day_abbr, month_name
+import os.path
+from calendar import month_name
+from json import dumps
 from logging import getLogger
 
-from flask import abort, redirect
+from flask import (
+    Response,
+    abort,
+    redirect,
+    request,
+    safe_join,
+    send_from_directory,
+)
 from flask_mako import render_template
 from mako.exceptions import TopLevelLookupException
 
+from presence_analyzer.helpers import STATIC_MAX_AGE, static_hash
 from presence_analyzer.main import app
+from presence_analyzer.responses import (
+    accepts_gzip,
+    conditional,
+    response_cache,
+)
+from presence_analyzer.store import format_month
 from presence_analyzer.utils import (
-    get_data,
-    get_full_users_data,
+    DATASETS,
+    WEEKDAY_METRICS,
+    get_aggregates,
+    get_date_range,
+    get_location_index,
+    get_month_range,
+    get_presence_store,
+    get_user_ids,
+    get_users_avatar_name,
     get_year_month_location,
-    group_by_weekday,
-    group_by_weekday_start_end,
     jsonify,
-    mean,
-    mean_by_weekday,
+    mean_time_weekday,
+    presence_start_end,
+    presence_weekday,
+    scheduler,
+    warm_up_status,
 )
 
 
@@ -46,94 +70,165 @@ def mainpage(tab):
         abort(404)
 
 
+@app.endpoint('static')
+def static_view(filename):
+    """
+    Serves static files, precompressed when client accepts gzip encoding.
+    Files requested by content-hashed URL are cached for a long time.
+    """
+    path = safe_join(app.static_folder, filename)
+    if not os.path.isfile(path):
+        abort(404)
+
+    options = {}
+    if request.args.get('v') == static_hash(filename):
+        options['cache_timeout'] = STATIC_MAX_AGE
+
+    if accepts_gzip() and os.path.isfile(path + '.gz'):
+        response = send_from_directory(
+            app.static_folder,
+            filename + '.gz',
+            mimetype=mimetypes.guess_type(filename)[0],
+            **options
+        )
+        response.content_encoding = 'gzip'
+    else:
+        response = send_from_directory(app.static_folder, filename, **options)
+
+    response.vary.add('Accept-Encoding')
+    if 'cache_timeout' in options:
+        response.cache_control.public = True
+    return response
+
+
 @app.route('/api/v1/users', methods=['GET'])
+@conditional(get_users_avatar_name)
 @jsonify
 def users_view():
     """
-    Users listing for dropdown.
+    Users listing for dropdown, sorted by name in Polish order.
+
+    Optional query parameters are `q`, prefix of names to search for, and
+    `offset` and `limit` to return a page of the listing.
     """
-    locale.setlocale(locale.LC_COLLATE, 'pl_PL.UTF-8')
-    data = get_full_users_data()
+    users = get_users_avatar_name()
+    begin, end = users.search(request.args.get('q', ''))
 
-    return sorted(
-        [
-            {
-                'user_id': i,
-                'name': data[i]['name'].encode('utf-8')
-            }
-            for i in data.keys()
-        ],
-        key=operator.itemgetter('name'),
-        cmp=locale.strcoll
-    )
+    try:
+        offset = int(request.args.get('offset', 0))
+        limit = int(request.args.get('limit', end - begin))
+    except ValueError:
+        log.debug('Invalid page %s', request.args)
+        abort(400)
+    if offset < 0 or limit < 0:
+        abort(400)
+
+    begin += offset
+    return users.listing(begin, max(begin, min(begin + limit, end)))
 
 
 @app.route('/api/v1/mean_time_weekday/<int:user_id>', methods=['GET'])
+@conditional(get_aggregates)
 @jsonify
 def mean_time_weekday_view(user_id):
     """
-    Returns mean presence time of given user grouped by weekday.
+    Returns mean presence time of given user grouped by weekday, optionally
+    limited to days between `from` and `to` query parameters.
     """
-    data = get_data()
-    if user_id not in data:
+    since, until = get_date_range()
+    store = get_presence_store()
+    if user_id not in store:
         log.debug('User %s not found!', user_id)
         abort(404)
 
-    weekdays = group_by_weekday(data[user_id])
-
-    return [
-        (day_abbr[weekday], mean(intervals))
-        for weekday, intervals in weekdays.items()
-    ]
+    return mean_time_weekday(store.weekday_totals(user_id, since, until))
 
 
 @app.route('/api/v1/presence_weekday/<int:user_id>', methods=['GET'])
+@conditional(get_aggregates)
 @jsonify
 def presence_weekday_view(user_id):
     """
-    Returns total presence time of given user grouped by weekday.
+    Returns total presence time of given user grouped by weekday, optionally
+    limited to days between `from` and `to` query parameters.
     """
-    data = get_data()
-    if user_id not in data:
+    since, until = get_date_range()
+    store = get_presence_store()
+    if user_id not in store:
         log.debug('User %s not found!', user_id)
         abort(404)
 
-    weekdays = group_by_weekday(data[user_id])
-    result = [
-        (day_abbr[weekday], sum(intervals))
-        for weekday, intervals in weekdays.items()
-    ]
-    result.insert(0, ('Weekday', 'Presence (s)'))
-
-    return result
+    return presence_weekday(store.weekday_totals(user_id, since, until))
 
 
 @app.route('/api/v1/presence_start_end/<int:user_id>', methods=['GET'])
+@conditional(get_aggregates)
 @jsonify
 def start_end_view(user_id):
     """
-    Returns interval of mean presence time of given user grouped by weekday.
+    Returns interval of mean presence time of given user grouped by weekday,
+    optionally limited to days between `from` and `to` query parameters.
     """
-    data = get_data()
-    if user_id not in data:
+    since, until = get_date_range()
+    store = get_presence_store()
+    if user_id not in store:
         log.debug('User %s not found!', user_id)
         abort(404)
 
-    weekdays_data = group_by_weekday_start_end(data[user_id])
+    return presence_start_end(store.weekday_totals(user_id, since, until))
+
+
+@app.route('/api/v1/batch', methods=['GET'])
+@conditional(get_aggregates)
+@jsonify
+def batch_view():
+    """
+    Returns statistics of many users in one response.
+
+    Query parameters are `users`, comma separated user ids or "all",
+    optional `metrics`, comma separated names of the per-user endpoints,
+    all of them by default, and optional `from` and `to` dates. Unknown
+    users are left out.
 
-    return [
-        mean_by_weekday(weekday, intervals)
-        for weekday, intervals in weekdays_data.items()
-    ]
+    Returns: (dict) - with results of metrics keyed by user_id, like:
+    {
+        '10': {
+            'mean_time_weekday': [['Mon', 24123.0], ...],
+            'presence_weekday': [['Weekday', 'Presence (s)'], ...],
+            'presence_start_end': [['Mon', 33134.0, 57257.0], ...],
+        },
+    }
+    """
+    since, until = get_date_range()
+    store = get_presence_store()
+    user_ids = get_user_ids(store)
+    metrics = request.args.get('metrics')
+    names = metrics.split(',') if metrics else list(WEEKDAY_METRICS)
+
+    if any(name not in WEEKDAY_METRICS for name in names):
+        log.debug('Unknown metrics %s', metrics)
+        abort(400)
+
+    return {
+        user_id: {
+            name: WEEKDAY_METRICS[name](
+                store.weekday_totals(user_id, since, until)
+            )
+            for name in names
+        }
+        for user_id in user_ids
+        if user_id in store
+    }
 
 
 @app.route('/api/v1/users/<int:usr_id>', methods=['GET'])
+@conditional(get_users_avatar_name)
 @jsonify
 def users_info_view(usr_id):
     """
     Returns information about given user.
     """
-    data = get_full_users_data()
+    data = get_users_avatar_name()
     if usr_id not in data:
         log.debug('User %s not found!', usr_id)
         abort(404)
@@ -149,6 +244,7 @@ def users_info_view(usr_id):
 
 
 @app.route('/api/v1/presence_location_view', methods=['GET'])
+@conditional(get_aggregates)
 @jsonify
 def year_month_view():
     """
@@ -170,6 +266,7 @@ def year_month_view():
 
 
 @app.route('/api/v1/presence_location_view/<string:date_id>', methods=['GET'])
+@conditional(get_aggregates)
 @jsonify
 def location_view(date_id):
     """
@@ -193,3 +290,91 @@ def location_view(date_id):
         'user_id': date_id,
         'locations': data[date_id],
     }
+
+
+@app.route('/api/v1/location_report', methods=['GET'])
+@conditional(get_aggregates)
+@jsonify
+def location_report_view():
+    """
+    Returns presence time by location for a range of months.
+
+    Query parameters are optional `from` and `to` months in YYYY-MM format
+    or `year`, all months by default, and optional `users`, comma separated
+    user ids or "all", to break the totals down by user. Unknown users are
+    left out.
+
+    Location totals sum every row of the CSV file, like the monthly
+    presence_location_view. Totals of users come from the presence store,
+    which keeps only the last entry of a user for a day, so with duplicated
+    rows they may add up to less than location totals.
+
+    Returns: (dict) - with totals, like:
+    {
+        'from': '2013-01',
+        'to': '2013-12',
+        'locations': {
+            'Pila': 3028793,
+            'Lodz': 2823194,
+        },
+        'users': {
+            '10': {
+                'Pila': 95412,
+            },
+        },
+    }
+    """
+    since, until = get_month_range()
+    store = get_presence_store()
+    result = {
+        'from': None if since is None else format_month(since),
+        'to': None if until is None else format_month(until),
+        'locations': get_location_index().totals(since, until),
+    }
+
+    if request.args.get('users'):
+        result['users'] = {
+            user_id: store.location_index(user_id).totals(since, until)
+            for user_id in get_user_ids(store)
+            if user_id in store
+        }
+
+    return result
+
+
+@app.route('/api/v1/cache_stats', methods=['GET'])
+@jsonify
+def cache_stats_view():
+    """
+    Returns refresh metrics of cached datasets and usage of response cache.
+    """
+    stats = {
+        function.__name__: function.cache.stats()
+        for function in DATASETS
+    }
+    stats['responses'] = response_cache.stats()
+
+    return stats
+
+
+@app.route('/api/v1/scheduler', methods=['GET'])
+@jsonify
+def scheduler_view():
+    """
+    Returns state of background refresh of cached datasets.
+    """
+    return scheduler.status()
+
+
+@app.route('/api/v1/ready', methods=['GET'])
+def ready_view():
+    """
+    Returns warm-up state, with 503 status until cached datasets are loaded.
+    """
+    ready = warm_up_status['state'] not in ('running', 'failed')
+
+    return Response(
+        dumps(warm_up_status),
+        status=200 if ready else 503,
+        mimetype='application/json'
+    )